@@ -0,0 +1,363 @@
+"""
+أداة قياس الأداء للبوت بدون تيليجرام حقيقي.
+
+  python bench/bench.py fake-api --port 8081 --latency-ms 40 --rate-429 0.01
+  BATMAN_CONFIG=bench/config.bench.json python bench/bench.py seed --users 1000000 --logs 2000000
+  BATMAN_CONFIG=bench/config.bench.json uvicorn main:app --port 10000
+  BATMAN_CONFIG=bench/config.bench.json python bench/bench.py run --scenario all
+"""
+import os
+import re
+import sys
+import json
+import time
+import random
+import string
+import sqlite3
+import asyncio
+import argparse
+from typing import Dict, List, Optional
+from urllib.parse import parse_qs
+
+import httpx
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+DEFAULT_CONFIG = os.path.join(ROOT, "bench", "config.bench.json")
+
+
+def load_config() -> dict:
+    path = os.environ.get("BATMAN_CONFIG", DEFAULT_CONFIG)
+    with open(path, "r", encoding="utf-8") as f:
+        return json.load(f)
+
+# =========================
+# Bot API وهمي
+# =========================
+def make_fake_api(latency_ms: float, jitter_ms: float, rate_429: float, retry_after: int, dead_rate: float = 0.0,
+                  exempt: frozenset = frozenset()):
+    from fastapi import FastAPI, Request
+    from fastapi.responses import JSONResponse
+
+    api = FastAPI(title="Fake Bot API")
+    stats: Dict[str, int] = {}
+    started = time.time()
+    seq = {"message_id": 0}
+
+    def message(chat_id, **extra):
+        seq["message_id"] += 1
+        return {"message_id": seq["message_id"], "date": int(time.time()),
+                "chat": {"id": int(chat_id or 0), "type": "private"}, **extra}
+
+    async def params(request: Request) -> dict:
+        body = await request.body()
+        ctype = request.headers.get("content-type", "")
+        if ctype.startswith("application/json"):
+            return json.loads(body or b"{}")
+        if ctype.startswith("application/x-www-form-urlencoded"):
+            return {k: v[0] for k, v in parse_qs(body.decode()).items()}
+        # multipart (sendDocument): يكفينا chat_id
+        m = re.search(rb'name="chat_id"\r\n\r\n([^\r]+)', body)
+        return {"chat_id": m.group(1).decode()} if m else {}
+
+    @api.post("/bot{token}/{method}")
+    async def call(token: str, method: str, request: Request):
+        data = await params(request)
+        delay = latency_ms + random.uniform(-jitter_ms, jitter_ms)
+        if delay > 0:
+            await asyncio.sleep(delay / 1000)
+        stats[method] = stats.get(method, 0) + 1
+        if method not in ("getMe", "setWebhook", "deleteWebhook") and random.random() < rate_429:
+            stats["429"] = stats.get("429", 0) + 1
+            return JSONResponse({"ok": False, "error_code": 429,
+                                 "description": f"Too Many Requests: retry after {retry_after}",
+                                 "parameters": {"retry_after": retry_after}}, status_code=429)
+        # نسبة ثابتة من المستخدمين "حظروا البوت": نفس الآيدي يفشل دائماً (الأدمن مستثنون)
+        chat_id = int(data.get("chat_id") or 0)
+        if method == "sendMessage" and chat_id not in exempt and chat_id % 1000 < dead_rate * 1000:
+            stats["403"] = stats.get("403", 0) + 1
+            return JSONResponse({"ok": False, "error_code": 403,
+                                 "description": "Forbidden: bot was blocked by the user"}, status_code=403)
+        if method == "getMe":
+            result = {"id": 1000, "is_bot": True, "first_name": "Bench", "username": "bench_bot",
+                      "can_join_groups": True, "can_read_all_group_messages": False,
+                      "supports_inline_queries": False}
+        elif method in ("sendMessage", "editMessageText", "editMessageReplyMarkup"):
+            result = message(data.get("chat_id"), text=data.get("text", ""))
+        elif method == "sendDocument":
+            result = message(data.get("chat_id"), document={"file_id": "bench", "file_unique_id": "bench"})
+        else:
+            result = True
+        return {"ok": True, "result": result}
+
+    @api.get("/stats")
+    async def get_stats():
+        return {"uptime": time.time() - started, "calls": stats}
+
+    @api.post("/stats/reset")
+    async def reset_stats():
+        stats.clear()
+        return {"ok": True}
+
+    return api
+
+# =========================
+# تعبئة القاعدة
+# =========================
+ACTIONS = ("stats", "broadcast", "ban", "unban", "vip", "backup", "accounts_update", "toggle_maintenance")
+
+def rand_name(rnd: random.Random, n: int) -> str:
+    return "".join(rnd.choices(string.ascii_lowercase, k=n))
+
+def seed(users: int, logs: int, chunk: int = 50_000, days: int = 365):
+    sys.path.insert(0, ROOT)
+    import main
+    # ينشئ الجداول والفهارس والـ triggers بنفس إعدادات BATMAN_CONFIG
+    asyncio.run(main.prepare_db())
+
+    rnd = random.Random(42)
+    con = sqlite3.connect(main.DB_PATH, isolation_level=None)
+    con.execute("PRAGMA synchronous=OFF")
+    start_id = (con.execute("SELECT MAX(user_id) FROM users").fetchone()[0] or 10_000_000) + 1
+    now = time.time()
+    t0 = time.time()
+    for base in range(0, users, chunk):
+        rows = []
+        for i in range(base, min(base + chunk, users)):
+            joined = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - rnd.random() * days * 86400))
+            rows.append((start_id + i, rand_name(rnd, 8), rand_name(rnd, 6).title(), rand_name(rnd, 7).title(),
+                         int(rnd.random() < 0.01), int(rnd.random() < 0.05), joined))
+        con.execute("BEGIN")
+        con.executemany("INSERT OR IGNORE INTO users(user_id, username, first_name, last_name, is_banned, is_vip, joined_at) "
+                        "VALUES(?,?,?,?,?,?,?)", rows)
+        con.execute("COMMIT")
+        print(f"users: {min(base + chunk, users)}/{users}", file=sys.stderr)
+    admins = main.ADMIN_IDS
+    for base in range(0, logs, chunk):
+        rows = []
+        for _ in range(base, min(base + chunk, logs)):
+            created = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(now - rnd.random() * days * 86400))
+            rows.append((rnd.choice(admins), rnd.choice(ACTIONS), None, created))
+        con.execute("BEGIN")
+        con.executemany("INSERT INTO logs(user_id, action, extra, created_at) VALUES(?,?,?,?)", rows)
+        con.execute("COMMIT")
+        print(f"logs: {min(base + chunk, logs)}/{logs}", file=sys.stderr)
+    con.execute("ANALYZE")
+    con.close()
+    print(json.dumps({"users": users, "logs": logs, "seconds": round(time.time() - t0, 1)}))
+
+# =========================
+# مولّد التحديثات
+# =========================
+class UpdateFactory:
+    def __init__(self):
+        self.update_id = int(time.time() * 1000)
+
+    def _next(self) -> int:
+        self.update_id += 1
+        return self.update_id
+
+    @staticmethod
+    def _user(uid: int) -> dict:
+        return {"id": uid, "is_bot": False, "first_name": f"u{uid}", "username": f"user{uid}"}
+
+    def text(self, uid: int, text: str) -> dict:
+        msg = {"message_id": self._next(), "date": int(time.time()),
+               "chat": {"id": uid, "type": "private"}, "from": self._user(uid), "text": text}
+        if text.startswith("/"):
+            msg["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+        return {"update_id": self._next(), "message": msg}
+
+    def callback(self, uid: int, data: str) -> dict:
+        return {"update_id": self._next(), "callback_query": {
+            "id": str(self._next()), "from": self._user(uid), "chat_instance": "bench", "data": data,
+            "message": {"message_id": 1, "date": int(time.time()),
+                        "chat": {"id": uid, "type": "private"}, "text": "panel"}}}
+
+class Client:
+    def __init__(self, cfg: dict, base_url: str):
+        token = cfg["BOT_TOKEN"]
+        self.url = f"{base_url.rstrip('/')}/webhook/{token}"
+        self.base_url = base_url.rstrip("/")
+        self.headers = {"X-Telegram-Bot-Api-Secret-Token": cfg["WEBHOOK_SECRET"]}
+        if cfg.get("METRICS_TOKEN"):
+            self.metrics_headers = {"Authorization": f"Bearer {cfg['METRICS_TOKEN']}"}
+        else:
+            self.metrics_headers = {}
+        self.http = httpx.AsyncClient(timeout=60, limits=httpx.Limits(max_connections=1000))
+        self.latencies: List[float] = []
+        self.errors: Dict[str, int] = {}
+
+    async def post(self, update: dict):
+        t0 = time.perf_counter()
+        try:
+            r = await self.http.post(self.url, json=update, headers=self.headers)
+            if r.status_code != 200:
+                self.errors[str(r.status_code)] = self.errors.get(str(r.status_code), 0) + 1
+        except httpx.HTTPError as e:
+            self.errors[type(e).__name__] = self.errors.get(type(e).__name__, 0) + 1
+        self.latencies.append(time.perf_counter() - t0)
+
+    async def metrics(self) -> Dict[str, float]:
+        r = await self.http.get(f"{self.base_url}/metrics", headers=self.metrics_headers)
+        out: Dict[str, float] = {}
+        for line in r.text.splitlines():
+            if line and not line.startswith("#"):
+                key, _, value = line.rpartition(" ")
+                out[key] = float(value)
+        return out
+
+def percentile(values: List[float], pct: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    return ordered[min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))]
+
+def db_contention(before: Dict[str, float], after: Dict[str, float]) -> Dict[str, float]:
+    # فرق مدرّج انتظار الكاتب/القارئ بين بداية السيناريو ونهايته
+    out = {}
+    for mode in ("write", "read"):
+        count = after.get(f'db_wait_seconds_count{{mode="{mode}"}}', 0) - before.get(f'db_wait_seconds_count{{mode="{mode}"}}', 0)
+        total = after.get(f'db_wait_seconds_sum{{mode="{mode}"}}', 0) - before.get(f'db_wait_seconds_sum{{mode="{mode}"}}', 0)
+        out[f"{mode}_acquires"] = int(count)
+        out[f"{mode}_wait_avg_ms"] = round(1000 * total / count, 3) if count else 0.0
+    rollbacks = sum(v for k, v in after.items() if k.startswith("db_rollbacks_total")) - \
+        sum(v for k, v in before.items() if k.startswith("db_rollbacks_total"))
+    out["rollbacks"] = int(rollbacks)
+    return out
+
+async def run_pool(coros, concurrency: int):
+    sem = asyncio.Semaphore(concurrency)
+
+    async def one(c):
+        async with sem:
+            await c
+
+    await asyncio.gather(*(one(c) for c in coros))
+
+async def scenario_start_flood(client: Client, factory: UpdateFactory, cfg: dict, n: int, concurrency: int, users: int):
+    rnd = random.Random(1)
+    await run_pool((client.post(factory.text(rnd.randint(1, users), "/start")) for _ in range(n)), concurrency)
+    return n
+
+async def scenario_stats(client: Client, factory: UpdateFactory, cfg: dict, n: int, concurrency: int, users: int):
+    admins = cfg["ADMIN_IDS"]
+    await run_pool((client.post(factory.callback(admins[i % len(admins)], "adm_stats")) for i in range(n)), concurrency)
+    return n
+
+async def scenario_admin_search(client: Client, factory: UpdateFactory, cfg: dict, n: int, concurrency: int, users: int):
+    # الحالة لكل أدمن: زر البحث ثم النص بالتتابع؛ التوازي بين الأدمنز فقط
+    admins = cfg["ADMIN_IDS"]
+    rnd = random.Random(2)
+
+    async def admin_loop(uid: int, count: int):
+        for _ in range(count):
+            await client.post(factory.callback(uid, "adm_search"))
+            await client.post(factory.text(uid, rand_name(rnd, 3)))
+
+    per_admin = max(1, n // (2 * len(admins)))
+    await asyncio.gather(*(admin_loop(uid, per_admin) for uid in admins))
+    return per_admin * 2 * len(admins)
+
+async def scenario_broadcast(client: Client, factory: UpdateFactory, cfg: dict, n: int, concurrency: int, users: int,
+                             fake_api: Optional[str] = None):
+    admin = cfg["ADMIN_IDS"][0]
+    fake = fake_api or cfg.get("BOT_API_URL", "")
+    if fake:
+        await client.http.post(f"{fake}/stats/reset")
+    await client.post(factory.callback(admin, "adm_broadcast"))
+    await client.post(factory.text(admin, "bench broadcast"))
+    # ننتظر انتهاء مهمة الإذاعة في الخلفية
+    seen_running = False
+    deadline = time.time() + 3600
+    while time.time() < deadline:
+        running = (await client.metrics()).get("broadcasts_running", 0)
+        seen_running = seen_running or running > 0
+        if seen_running and running == 0:
+            break
+        await asyncio.sleep(0.5)
+    if fake:
+        calls = (await client.http.get(f"{fake}/stats")).json()["calls"]
+        return calls.get("sendMessage", 0)
+    return 0
+
+SCENARIOS = {
+    "start_flood": scenario_start_flood,
+    "stats": scenario_stats,
+    "admin_search": scenario_admin_search,
+    "broadcast": scenario_broadcast,
+}
+
+async def run(args):
+    cfg = load_config()
+    base_url = args.url or cfg["WEBHOOK_HOST"]
+    names = list(SCENARIOS) if args.scenario == "all" else [args.scenario]
+    client = Client(cfg, base_url)
+    factory = UpdateFactory()
+    reports = []
+    try:
+        for name in names:
+            client.latencies, client.errors = [], {}
+            before = await client.metrics()
+            t0 = time.perf_counter()
+            done = await SCENARIOS[name](client, factory, cfg, args.updates, args.concurrency, args.users)
+            wall = time.perf_counter() - t0
+            after = await client.metrics()
+            report = {
+                "scenario": name,
+                "requests": len(client.latencies),
+                "seconds": round(wall, 3),
+                "updates_per_sec": round(len(client.latencies) / wall, 1) if wall else 0,
+                "p50_ms": round(1000 * percentile(client.latencies, 50), 2),
+                "p99_ms": round(1000 * percentile(client.latencies, 99), 2),
+                "errors": client.errors,
+                "db": db_contention(before, after),
+            }
+            if name == "broadcast":
+                report["messages_sent"] = done
+                report["messages_per_sec"] = round(done / wall, 1) if wall else 0
+            reports.append(report)
+            print(json.dumps(report, ensure_ascii=False))
+    finally:
+        await client.http.aclose()
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as f:
+            json.dump(reports, f, ensure_ascii=False, indent=2)
+
+def main_cli():
+    parser = argparse.ArgumentParser(description="Batman bot benchmark harness")
+    sub = parser.add_subparsers(dest="cmd", required=True)
+
+    p = sub.add_parser("fake-api", help="run a local stand-in for the Telegram Bot API")
+    p.add_argument("--host", default="127.0.0.1")
+    p.add_argument("--port", type=int, default=8081)
+    p.add_argument("--latency-ms", type=float, default=40)
+    p.add_argument("--jitter-ms", type=float, default=10)
+    p.add_argument("--rate-429", type=float, default=0.0, help="probability of answering 429")
+    p.add_argument("--retry-after", type=int, default=1)
+    p.add_argument("--dead-rate", type=float, default=0.0, help="share of chat ids answering 403 (blocked)")
+
+    p = sub.add_parser("seed", help="fill users and logs with synthetic rows")
+    p.add_argument("--users", type=int, default=1_000_000)
+    p.add_argument("--logs", type=int, default=2_000_000)
+
+    p = sub.add_parser("run", help="POST synthetic updates to the webhook and report latency")
+    p.add_argument("--scenario", choices=[*SCENARIOS, "all"], default="all")
+    p.add_argument("--url", help="bot base url (default: WEBHOOK_HOST from config)")
+    p.add_argument("--updates", type=int, default=2000)
+    p.add_argument("--concurrency", type=int, default=50)
+    p.add_argument("--users", type=int, default=100_000, help="distinct user ids for start_flood")
+    p.add_argument("--out", help="write reports as JSON to this file")
+
+    args = parser.parse_args()
+    if args.cmd == "fake-api":
+        import uvicorn
+        uvicorn.run(make_fake_api(args.latency_ms, args.jitter_ms, args.rate_429, args.retry_after,
+                                  args.dead_rate, frozenset(load_config()["ADMIN_IDS"])),
+                    host=args.host, port=args.port, log_level="warning")
+    elif args.cmd == "seed":
+        seed(args.users, args.logs)
+    else:
+        asyncio.run(run(args))
+
+if __name__ == "__main__":
+    main_cli()
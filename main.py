@@ -1,17 +1,46 @@
 import os
+import re
+import gzip
+import html
 import json
+import time
+import shutil
+import socket
+import sqlite3
+import tarfile
+import tempfile
 import asyncio
-from typing import Optional, Dict, List
+import logging
+import functools
+from bisect import bisect_left
+from contextvars import ContextVar
+from collections import OrderedDict
+from contextlib import asynccontextmanager, contextmanager
+from typing import Optional, Dict, List, Set, Tuple, Any, Iterable, Callable
 
 from fastapi import FastAPI, Request, Header, HTTPException
-from fastapi.responses import JSONResponse
+from fastapi.responses import JSONResponse, PlainTextResponse
 
 import aiosqlite
 
+try:
+    import fcntl
+except ImportError:  # ويندوز: لا قفل ملفات، يُفترض عامل واحد
+    fcntl = None
+
+try:
+    import orjson  # اختياري: تحليل أسرع لأجسام الويبهوك
+    json_loads = orjson.loads
+except ImportError:
+    orjson = None
+    json_loads = json.loads
+
 from telegram import (
     Update, InlineKeyboardMarkup, InlineKeyboardButton, InputFile
 )
 from telegram.constants import ParseMode
+from telegram.error import BadRequest, Forbidden, NetworkError, RetryAfter, TelegramError
+from telegram.request import HTTPXRequest
 from telegram.ext import (
     Application, ApplicationBuilder, CommandHandler, MessageHandler,
     CallbackQueryHandler, ContextTypes, AIORateLimiter, filters
@@ -20,7 +49,9 @@ from telegram.ext import (
 # =========================
 # تحميل الإعدادات
 # =========================
-with open("config.json", "r", encoding="utf-8") as f:
+# BATMAN_CONFIG يسمح بتشغيل نسخة بإعدادات أخرى (مثل bench/config.bench.json)
+CONFIG_PATH = os.environ.get("BATMAN_CONFIG", "config.json")
+with open(CONFIG_PATH, "r", encoding="utf-8") as f:
     CFG = json.load(f)
 
 BOT_NAME: str = CFG.get("BOT_NAME", "Batman")
@@ -31,42 +62,223 @@ WEBHOOK_SECRET: str = CFG["WEBHOOK_SECRET"]
 APP_PORT: int = int(CFG.get("APP_PORT", 10000))
 CONTACT_URL: str = CFG.get("CONTACT_URL", "https://t.me/e2E12")
 MAINTENANCE_DEFAULT: bool = bool(CFG.get("MAINTENANCE", False))
+DB_READERS: int = int(CFG.get("DB_READERS", 4))
+LOG_BATCH_SIZE: int = int(CFG.get("LOG_BATCH_SIZE", 200))
+LOG_FLUSH_SECONDS: float = float(CFG.get("LOG_FLUSH_SECONDS", 2.0))
+USER_CACHE_SIZE: int = int(CFG.get("USER_CACHE_SIZE", 50000))
+USER_FLUSH_SECONDS: float = float(CFG.get("USER_FLUSH_SECONDS", 1.0))
+BROADCAST_CONCURRENCY: int = int(CFG.get("BROADCAST_CONCURRENCY", 8))
+BROADCAST_RATE: float = float(CFG.get("BROADCAST_RATE", 25))  # رسالة/ثانية (حد البوت ~30)
+BROADCAST_PAGE: int = int(CFG.get("BROADCAST_PAGE", 200))
+BROADCAST_RETRIES: int = int(CFG.get("BROADCAST_RETRIES", 3))
+SEARCH_PAGE: int = int(CFG.get("SEARCH_PAGE", 20))
+LIST_PAGE: int = int(CFG.get("LIST_PAGE", 20))
+ACCOUNTS_PAGE: int = int(CFG.get("ACCOUNTS_PAGE", 20))
+BACKUP_CHUNK: int = int(CFG.get("BACKUP_CHUNK", 5000))
+BACKUP_KEEP: int = int(CFG.get("BACKUP_KEEP", 3))
+# حد رفع الملفات في Bot API (50 MB): الأرشيف الأكبر يبقى على القرص ويُبلَّغ الأدمن بمساره
+BACKUP_SEND_MAX_BYTES: int = int(CFG.get("BACKUP_SEND_MAX_BYTES", 50 * 1024 * 1024))
+LOG_RETENTION_DAYS: int = int(CFG.get("LOG_RETENTION_DAYS", 90))
+LOG_MAX_ROWS: int = int(CFG.get("LOG_MAX_ROWS", 1_000_000))
+HOUSEKEEPING_HOURS: float = float(CFG.get("HOUSEKEEPING_HOURS", 6))
+STATE_BACKEND: str = CFG.get("STATE_BACKEND", "sqlite")  # sqlite (مشترك بين العمّال) | memory
+STATE_TTL: float = float(CFG.get("STATE_TTL", 900))
+CACHE_REFRESH_SECONDS: float = float(CFG.get("CACHE_REFRESH_SECONDS", 5))
+METRICS_TOKEN: str = CFG.get("METRICS_TOKEN", "")
+# رمز مستقل عن WEBHOOK_SECRET؛ بدونه تُعطَّل /stats
+STATS_TOKEN: str = CFG.get("STATS_TOKEN", "")
+SLOW_HANDLER_MS: float = float(CFG.get("SLOW_HANDLER_MS", 1000))
+BOT_API_URL: str = CFG.get("BOT_API_URL", "").rstrip("/")  # فارغ = https://api.telegram.org
+INGEST_MODE: str = CFG.get("INGEST_MODE", "inline")  # inline | queue
+UPDATE_WORKERS: int = int(CFG.get("UPDATE_WORKERS", 4))
+UPDATE_QUEUE_SIZE: int = int(CFG.get("UPDATE_QUEUE_SIZE", 1000))
+DEDUP_WINDOW: int = int(CFG.get("DEDUP_WINDOW", 10000))
+DEDUP_FLUSH_SECONDS: float = float(CFG.get("DEDUP_FLUSH_SECONDS", 5))
+FLOOD_RATE: float = float(CFG.get("FLOOD_RATE", 1))  # تحديث/ثانية لكل مستخدم
+FLOOD_BURST: float = float(CFG.get("FLOOD_BURST", 5))
+FLOOD_USERS: int = int(CFG.get("FLOOD_USERS", 100000))
+MAX_INFLIGHT: int = int(CFG.get("MAX_INFLIGHT", 64))  # 0 = بلا حد
+BULK_MAX_IDS: int = int(CFG.get("BULK_MAX_IDS", 100000))
+BULK_FILE_MAX_BYTES: int = int(CFG.get("BULK_FILE_MAX_BYTES", 2 * 1024 * 1024))
+
+log = logging.getLogger(BOT_NAME)
+
+# =========================
+# القياسات (/metrics بصيغة Prometheus)
+# =========================
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+
+class Metrics:
+    """عدّادات ومدرّجات زمنية داخل العامل، تُعرض نصياً على /metrics (كل عامل uvicorn له أرقامه)."""
+
+    def __init__(self, buckets: tuple = LATENCY_BUCKETS):
+        self.buckets = buckets
+        self._help: Dict[str, tuple] = {}
+        self._counters: Dict[tuple, float] = {}
+        self._hists: Dict[tuple, List[float]] = {}
+        self._gauges: Dict[str, Callable[[], float]] = {}
+
+    def describe(self, name: str, kind: str, text: str):
+        self._help[name] = (kind, text)
+
+    def inc(self, name: str, value: float = 1, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        self._counters[key] = self._counters.get(key, 0) + value
+
+    def observe(self, name: str, seconds: float, **labels):
+        key = (name, tuple(sorted(labels.items())))
+        h = self._hists.get(key)
+        if h is None:
+            # عدّاد لكل خانة (غير تراكمي) ثم المجموع ثم العدد
+            h = self._hists[key] = [0] * len(self.buckets) + [0.0, 0]
+        idx = bisect_left(self.buckets, seconds)
+        if idx < len(self.buckets):
+            h[idx] += 1
+        h[-2] += seconds
+        h[-1] += 1
+
+    def gauge(self, name: str, fn: Callable[[], float], text: str = ""):
+        self._gauges[name] = fn
+        self.describe(name, "gauge", text)
+
+    @contextmanager
+    def timer(self, name: str, **labels):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - t0, **labels)
+
+    @staticmethod
+    def _labels(pairs, extra: str = "") -> str:
+        parts = ['%s="%s"' % (k, str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n"))
+                 for k, v in pairs]
+        if extra:
+            parts.append(extra)
+        return "{" + ",".join(parts) + "}" if parts else ""
+
+    def render(self) -> str:
+        lines: List[str] = []
+        seen: Set[str] = set()
+
+        def header(name: str, default_kind: str):
+            if name in seen:
+                return
+            seen.add(name)
+            kind, text = self._help.get(name, (default_kind, ""))
+            if text:
+                lines.append(f"# HELP {name} {text}")
+            lines.append(f"# TYPE {name} {kind}")
+
+        for (name, pairs), value in sorted(self._counters.items()):
+            header(name, "counter")
+            lines.append(f"{name}{self._labels(pairs)} {value}")
+        for (name, pairs), h in sorted(self._hists.items()):
+            header(name, "histogram")
+            cumulative = 0
+            for le, n in zip(self.buckets, h):
+                cumulative += n
+                lines.append("%s_bucket%s %d" % (name, self._labels(pairs, 'le="%s"' % le), cumulative))
+            lines.append("%s_bucket%s %d" % (name, self._labels(pairs, 'le="+Inf"'), h[-1]))
+            lines.append(f"{name}_sum{self._labels(pairs)} {h[-2]}")
+            lines.append(f"{name}_count{self._labels(pairs)} {h[-1]}")
+        for name, fn in sorted(self._gauges.items()):
+            header(name, "gauge")
+            try:
+                lines.append(f"{name} {float(fn())}")
+            except Exception:
+                log.exception("gauge %s failed", name)
+        return "\n".join(lines) + "\n"
+
+metrics = Metrics()
+metrics.describe("webhook_seconds", "histogram", "Webhook request latency")
+metrics.describe("handler_seconds", "histogram", "Time spent in PTB handlers")
+metrics.describe("db_query_seconds", "histogram", "SQLite query latency")
+metrics.describe("db_wait_seconds", "histogram", "Time waiting for a pooled SQLite connection")
+metrics.describe("db_hold_seconds", "histogram", "Time a pooled SQLite connection was held")
+metrics.describe("bot_api_seconds", "histogram", "Bot API call latency")
+
+@functools.lru_cache(maxsize=512)
+def sql_label(sql: str) -> str:
+    # "SELECT ... FROM users" -> select_users (تسمية ثابتة منخفضة التنوع للقياسات)
+    words = sql.split()
+    verb = words[0].lower() if words else "sql"
+    m = re.search(r"\b(?:FROM|INTO|UPDATE)\s+(\w+)", sql, re.IGNORECASE)
+    return f"{verb}_{m.group(1)}" if m else verb
+
+class InstrumentedRequest(HTTPXRequest):
+    """يقيس زمن كل استدعاء لـ Bot API وأخطاءه حسب اسم الدالة."""
+
+    async def do_request(self, url: str, method: str, *args, **kwargs):
+        api_method = url.rsplit("/", 1)[-1]
+        t0 = time.perf_counter()
+        try:
+            code, payload = await super().do_request(url, method, *args, **kwargs)
+        except Exception as e:
+            metrics.inc("bot_api_errors_total", method=api_method, error=type(e).__name__)
+            raise
+        finally:
+            metrics.observe("bot_api_seconds", time.perf_counter() - t0, method=api_method)
+        if code >= 400:
+            metrics.inc("bot_api_errors_total", method=api_method, error=str(code))
+        return code, payload
+
+# تسمية فرعية يضبطها الهاندلر نفسه (مثل mode في text_handler)
+HANDLER_LABEL: ContextVar[str] = ContextVar("handler_label", default="")
+
+def timed_handler(name: str, label: Optional[Callable[[Any], str]] = None):
+    def wrap(fn):
+        @functools.wraps(fn)
+        async def inner(update, context):
+            token = HANDLER_LABEL.set(label(update) if label else "")
+            status = "ok"
+            t0 = time.perf_counter()
+            try:
+                return await fn(update, context)
+            except Exception:
+                status = "error"
+                raise
+            finally:
+                elapsed = time.perf_counter() - t0
+                sub = HANDLER_LABEL.get()
+                HANDLER_LABEL.reset(token)
+                metrics.observe("handler_seconds", elapsed, handler=name, label=sub)
+                metrics.inc("handler_calls_total", handler=name, label=sub, status=status)
+                if SLOW_HANDLER_MS > 0 and elapsed * 1000 >= SLOW_HANDLER_MS:
+                    log.warning("slow handler %s[%s]: %.0f ms", name, sub, elapsed * 1000)
+        return inner
+    return wrap
+
+def callback_label(update) -> str:
+    data = (update.callback_query.data or "") if update.callback_query else ""
+    # أزرار التصفح تحمل مؤشراً؛ نكتفي بالبادئة
+    return data.split(":", 1)[0]
 
 WEBHOOK_PATH = f"/webhook/{BOT_TOKEN}"
 
-DATA_DIR = "data"
+DATA_DIR = CFG.get("DATA_DIR", "data")
 os.makedirs(DATA_DIR, exist_ok=True)
 DB_PATH = os.path.join(DATA_DIR, "batman.db")
+BACKUP_DIR = os.path.join(DATA_DIR, "backups")
+ARCHIVE_DIR = os.path.join(DATA_DIR, "archive")
 
+# accounts.json يُستورد مرة واحدة إلى جدول accounts عند أول تشغيل
 ACCOUNTS_FILE = "accounts.json"
-if not os.path.exists(ACCOUNTS_FILE):
-    with open(ACCOUNTS_FILE, "w", encoding="utf-8") as f:
-        json.dump({"instagram": [], "telegram": []}, f, ensure_ascii=False, indent=2)
-
-def load_accounts():
-    try:
-        with open(ACCOUNTS_FILE, "r", encoding="utf-8") as f:
-            data = json.load(f)
-            return data.get("instagram", []), data.get("telegram", [])
-    except Exception:
-        return [], []
-
-def save_accounts(insta_list, tg_list):
-    with open(ACCOUNTS_FILE, "w", encoding="utf-8") as f:
-        json.dump({"instagram": insta_list, "telegram": tg_list}, f, ensure_ascii=False, indent=2)
-
-instagram_accounts, telegram_accounts = load_accounts()
+ACCOUNT_KINDS = {"insta": "instagram", "tg": "telegram"}
 
 # =========================
 # FastAPI & Telegram
 # =========================
 app = FastAPI(title=f"{BOT_NAME} Control Bot")
-application: Application = (
+builder = (
     ApplicationBuilder()
     .token(BOT_TOKEN)
+    .request(InstrumentedRequest(connection_pool_size=256))
     .rate_limiter(AIORateLimiter())
-    .build()
 )
+if BOT_API_URL:
+    builder = builder.base_url(f"{BOT_API_URL}/bot").base_file_url(f"{BOT_API_URL}/file/bot")
+application: Application = builder.build()
 
 # =========================
 # قاعدة البيانات
@@ -78,7 +290,10 @@ CREATE TABLE IF NOT EXISTS users(
   username TEXT, first_name TEXT, last_name TEXT,
   is_banned INTEGER DEFAULT 0,
   is_vip INTEGER DEFAULT 0,
-  joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP
+  joined_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  reachable INTEGER NOT NULL DEFAULT 1,
+  last_error TEXT,
+  last_error_at TIMESTAMP
 );
 CREATE TABLE IF NOT EXISTS logs(
   id INTEGER PRIMARY KEY AUTOINCREMENT,
@@ -91,22 +306,591 @@ CREATE TABLE IF NOT EXISTS settings(
   key TEXT PRIMARY KEY,
   value TEXT
 );
+CREATE INDEX IF NOT EXISTS idx_users_banned ON users(user_id) WHERE is_banned=1;
+CREATE INDEX IF NOT EXISTS idx_users_username ON users(username COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_users_first_name ON users(first_name COLLATE NOCASE);
+CREATE INDEX IF NOT EXISTS idx_users_last_name ON users(last_name COLLATE NOCASE);
+CREATE TABLE IF NOT EXISTS accounts(
+  kind TEXT NOT NULL,
+  name TEXT NOT NULL,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  PRIMARY KEY(kind, name)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS admin_state(
+  user_id INTEGER PRIMARY KEY,
+  data TEXT NOT NULL,
+  expires_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS seen_updates(
+  update_id INTEGER PRIMARY KEY,
+  seen_at REAL NOT NULL
+);
+CREATE TABLE IF NOT EXISTS leases(
+  name TEXT PRIMARY KEY,
+  owner TEXT NOT NULL,
+  expires_at REAL NOT NULL
+);
+CREATE INDEX IF NOT EXISTS idx_users_joined ON users(joined_at, user_id);
+CREATE INDEX IF NOT EXISTS idx_logs_created ON logs(created_at);
+CREATE INDEX IF NOT EXISTS idx_logs_user ON logs(user_id);
+CREATE TABLE IF NOT EXISTS broadcasts(
+  id INTEGER PRIMARY KEY AUTOINCREMENT,
+  admin_id INTEGER,
+  text TEXT,
+  status TEXT DEFAULT 'running',
+  cursor INTEGER DEFAULT 0,
+  total INTEGER DEFAULT 0,
+  sent INTEGER DEFAULT 0,
+  failed INTEGER DEFAULT 0,
+  created_at TIMESTAMP DEFAULT CURRENT_TIMESTAMP,
+  finished_at TIMESTAMP
+);
+"""
+
+# فهرس نصي (trigram) للبحث الجزئي في الآيدي/اليوزر/الاسم، متزامن مع users عبر triggers
+FTS_SQL = """
+CREATE VIRTUAL TABLE IF NOT EXISTS users_fts USING fts5(
+  user_id, username, first_name, last_name,
+  content='users', content_rowid='user_id', tokenize='trigram'
+);
+CREATE TRIGGER IF NOT EXISTS users_fts_ai AFTER INSERT ON users BEGIN
+  INSERT INTO users_fts(rowid, user_id, username, first_name, last_name)
+  VALUES (new.user_id, new.user_id, new.username, new.first_name, new.last_name);
+END;
+CREATE TRIGGER IF NOT EXISTS users_fts_ad AFTER DELETE ON users BEGIN
+  INSERT INTO users_fts(users_fts, rowid, user_id, username, first_name, last_name)
+  VALUES ('delete', old.user_id, old.user_id, old.username, old.first_name, old.last_name);
+END;
+CREATE TRIGGER IF NOT EXISTS users_fts_au AFTER UPDATE OF username, first_name, last_name ON users BEGIN
+  INSERT INTO users_fts(users_fts, rowid, user_id, username, first_name, last_name)
+  VALUES ('delete', old.user_id, old.user_id, old.username, old.first_name, old.last_name);
+  INSERT INTO users_fts(rowid, user_id, username, first_name, last_name)
+  VALUES (new.user_id, new.user_id, new.username, new.first_name, new.last_name);
+END;
 """
 
-async def adb():
-    return await aiosqlite.connect(DB_PATH)
+# أعمدة أُضيفت لاحقاً لجدول users: تُضاف بـ ALTER TABLE على القواعد القديمة
+USERS_MIGRATIONS = {
+    "reachable": "ALTER TABLE users ADD COLUMN reachable INTEGER NOT NULL DEFAULT 1",
+    "last_error": "ALTER TABLE users ADD COLUMN last_error TEXT",
+    "last_error_at": "ALTER TABLE users ADD COLUMN last_error_at TIMESTAMP",
+}
+
+# جمهور الإذاعة: فهرس جزئي يستبعد المحظورين ومن لا يمكن الوصول إليهم
+AUDIENCE_SQL = """
+CREATE INDEX IF NOT EXISTS idx_users_audience ON users(user_id) WHERE is_banned=0 AND reachable=1;
+CREATE INDEX IF NOT EXISTS idx_users_unreachable ON users(last_error_at) WHERE reachable=0;
+"""
+
+# عدادات الإحصائيات: تُحدَّث تدريجياً عبر triggers فتُقرأ الإحصائيات بصف واحد لكل عداد
+COUNTERS_SQL = """
+CREATE TABLE IF NOT EXISTS counters(
+  name TEXT PRIMARY KEY,
+  value INTEGER NOT NULL DEFAULT 0
+);
+INSERT OR IGNORE INTO counters(name, value) VALUES('users', 0), ('banned', 0), ('vip', 0);
+CREATE TRIGGER IF NOT EXISTS users_cnt_ai AFTER INSERT ON users BEGIN
+  UPDATE counters SET value = value + 1 WHERE name='users';
+  UPDATE counters SET value = value + (new.is_banned=1) WHERE name='banned';
+  UPDATE counters SET value = value + (new.is_vip=1) WHERE name='vip';
+END;
+CREATE TRIGGER IF NOT EXISTS users_cnt_ad AFTER DELETE ON users BEGIN
+  UPDATE counters SET value = value - 1 WHERE name='users';
+  UPDATE counters SET value = value - (old.is_banned=1) WHERE name='banned';
+  UPDATE counters SET value = value - (old.is_vip=1) WHERE name='vip';
+END;
+CREATE TRIGGER IF NOT EXISTS users_cnt_au AFTER UPDATE OF is_banned, is_vip ON users
+WHEN old.is_banned IS NOT new.is_banned OR old.is_vip IS NOT new.is_vip BEGIN
+  UPDATE counters SET value = value + (new.is_banned=1) - (old.is_banned=1) WHERE name='banned';
+  UPDATE counters SET value = value + (new.is_vip=1) - (old.is_vip=1) WHERE name='vip';
+END;
+-- أرقام أجيال يقرؤها كل عامل دورياً ليعرف متى يعيد تحميل كاشه
+INSERT OR IGNORE INTO counters(name, value) VALUES('bans_gen', 0), ('settings_gen', 0);
+-- من حظروا البوت أو حُذفت حساباتهم (reachable=0)
+INSERT OR IGNORE INTO counters(name, value) VALUES('unreachable', 0);
+CREATE TRIGGER IF NOT EXISTS users_unreach_ai AFTER INSERT ON users BEGIN
+  UPDATE counters SET value = value + (new.reachable=0) WHERE name='unreachable';
+END;
+CREATE TRIGGER IF NOT EXISTS users_unreach_ad AFTER DELETE ON users BEGIN
+  UPDATE counters SET value = value - (old.reachable=0) WHERE name='unreachable';
+END;
+CREATE TRIGGER IF NOT EXISTS users_unreach_au AFTER UPDATE OF reachable ON users
+WHEN old.reachable IS NOT new.reachable BEGIN
+  UPDATE counters SET value = value + (new.reachable=0) - (old.reachable=0) WHERE name='unreachable';
+END;
+-- كل العمّال يطردون بصمات من صاروا unreachable كي يُكتب أول ظهور لهم من جديد
+INSERT OR IGNORE INTO counters(name, value) VALUES('reach_gen', 0);
+CREATE TRIGGER IF NOT EXISTS users_reach_gen AFTER UPDATE OF reachable ON users
+WHEN old.reachable=1 AND new.reachable=0 BEGIN
+  UPDATE counters SET value = value + 1 WHERE name='reach_gen';
+END;
+-- أعلى update_id اكتملت معالجته (يمنع إعادة معالجة ما يعيد تيليجرام إرساله بعد إعادة التشغيل)
+INSERT OR IGNORE INTO counters(name, value) VALUES('update_hwm', 0);
+CREATE TRIGGER IF NOT EXISTS users_bans_gen AFTER UPDATE OF is_banned ON users
+WHEN old.is_banned IS NOT new.is_banned BEGIN
+  UPDATE counters SET value = value + 1 WHERE name='bans_gen';
+END;
+CREATE TRIGGER IF NOT EXISTS settings_gen_ai AFTER INSERT ON settings BEGIN
+  UPDATE counters SET value = value + 1 WHERE name='settings_gen';
+END;
+CREATE TRIGGER IF NOT EXISTS settings_gen_au AFTER UPDATE ON settings BEGIN
+  UPDATE counters SET value = value + 1 WHERE name='settings_gen';
+END;
+"""
+
+# إحصائيات يومية تُحدَّث مع كل كتابة (triggers) فتُقرأ بلا مسح لجدولي users/logs.
+# daily_actions لا تنقص عند أرشفة السجلات: التاريخ يبقى بعد حذف الصفوف القديمة.
+ROLLUPS_SQL = """
+CREATE TABLE IF NOT EXISTS daily_joins(
+  day TEXT PRIMARY KEY,
+  count INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_active(
+  day TEXT NOT NULL,
+  user_id INTEGER NOT NULL,
+  PRIMARY KEY(day, user_id)
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_dau(
+  day TEXT PRIMARY KEY,
+  count INTEGER NOT NULL DEFAULT 0
+) WITHOUT ROWID;
+CREATE TABLE IF NOT EXISTS daily_actions(
+  day TEXT NOT NULL,
+  action TEXT NOT NULL,
+  user_id INTEGER NOT NULL,
+  count INTEGER NOT NULL DEFAULT 0,
+  PRIMARY KEY(day, action, user_id)
+) WITHOUT ROWID;
+CREATE TRIGGER IF NOT EXISTS users_joins_ai AFTER INSERT ON users BEGIN
+  INSERT INTO daily_joins(day, count) VALUES(COALESCE(date(new.joined_at), date('now')), 1)
+  ON CONFLICT(day) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS users_joins_ad AFTER DELETE ON users BEGIN
+  UPDATE daily_joins SET count = count - 1 WHERE day = COALESCE(date(old.joined_at), date('now'));
+END;
+CREATE TRIGGER IF NOT EXISTS active_dau_ai AFTER INSERT ON daily_active BEGIN
+  INSERT INTO daily_dau(day, count) VALUES(new.day, 1)
+  ON CONFLICT(day) DO UPDATE SET count = count + 1;
+END;
+CREATE TRIGGER IF NOT EXISTS logs_actions_ai AFTER INSERT ON logs BEGIN
+  INSERT INTO daily_actions(day, action, user_id, count)
+  VALUES(COALESCE(date(new.created_at), date('now')), COALESCE(new.action, ''), COALESCE(new.user_id, 0), 1)
+  ON CONFLICT(day, action, user_id) DO UPDATE SET count = count + 1;
+END;
+"""
+
+# إعدادات تُضبط مرة واحدة لكل اتصال دائم (journal_mode=WAL محفوظ داخل ملف القاعدة)
+CONN_PRAGMAS = (
+    "PRAGMA busy_timeout=5000",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA cache_size=-8000",
+)
+
+class DBPool:
+    """اتصالات دائمة: كاتب واحد محمي بقفل + عدة قرّاء (WAL يسمح بالقراءة المتوازية)."""
+
+    def __init__(self, path: str, readers: int = 4):
+        self.path = path
+        self.readers = max(1, readers)
+        self._writer: Optional[aiosqlite.Connection] = None
+        self._idle: Optional[asyncio.Queue] = None
+        self._conns: List[aiosqlite.Connection] = []
+        self._write_lock = asyncio.Lock()
+        self._open_lock = asyncio.Lock()
+
+    async def _connect(self, readonly: bool) -> aiosqlite.Connection:
+        con = await aiosqlite.connect(self.path)
+        for pragma in CONN_PRAGMAS:
+            await con.execute(pragma)
+        if readonly:
+            await con.execute("PRAGMA query_only=1")
+        self._conns.append(con)
+        return con
+
+    async def open(self):
+        async with self._open_lock:
+            if self._writer is not None:
+                return
+            self._writer = await self._connect(readonly=False)
+            self._idle = asyncio.Queue()
+            for _ in range(self.readers):
+                self._idle.put_nowait(await self._connect(readonly=True))
+
+    async def close(self):
+        async with self._open_lock:
+            for con in self._conns:
+                await con.close()
+            self._conns.clear()
+            self._writer, self._idle = None, None
+
+    @asynccontextmanager
+    async def read(self):
+        if self._writer is None:
+            await self.open()
+        t0 = time.perf_counter()
+        con = await self._idle.get()
+        t1 = time.perf_counter()
+        metrics.observe("db_wait_seconds", t1 - t0, mode="read")
+        try:
+            yield con
+        finally:
+            self._idle.put_nowait(con)
+            metrics.observe("db_hold_seconds", time.perf_counter() - t1, mode="read")
+
+    @asynccontextmanager
+    async def write(self, label: str = "tx"):
+        # معاملة واحدة: commit عند النجاح و rollback عند أي خطأ
+        if self._writer is None:
+            await self.open()
+        t0 = time.perf_counter()
+        async with self._write_lock:
+            t1 = time.perf_counter()
+            metrics.observe("db_wait_seconds", t1 - t0, mode="write")
+            try:
+                yield self._writer
+                await self._writer.commit()
+            except BaseException:
+                await self._writer.rollback()
+                metrics.inc("db_rollbacks_total", label=label)
+                raise
+            finally:
+                metrics.observe("db_hold_seconds", time.perf_counter() - t1, mode="write")
+                metrics.observe("db_query_seconds", time.perf_counter() - t1, query=label)
+
+    async def fetchone(self, sql: str, params: Iterable[Any] = ()):
+        async with self.read() as con:
+            with metrics.timer("db_query_seconds", query=sql_label(sql)):
+                async with con.execute(sql, tuple(params)) as cur:
+                    return await cur.fetchone()
+
+    async def fetchall(self, sql: str, params: Iterable[Any] = ()):
+        async with self.read() as con:
+            with metrics.timer("db_query_seconds", query=sql_label(sql)):
+                return await con.execute_fetchall(sql, tuple(params))
+
+    async def fetchval(self, sql: str, params: Iterable[Any] = (), default: Any = None):
+        row = await self.fetchone(sql, params)
+        return row[0] if row else default
+
+db = DBPool(DB_PATH, readers=DB_READERS)
+
+class WriteBehind:
+    """يجمع الصفوف في الذاكرة ويكتبها دفعة واحدة (executemany) بمعاملة واحدة لكل دفعة.
+
+    مع key: الصفوف ذات المفتاح نفسه تُدمج ويبقى آخرها فقط.
+    """
+
+    def __init__(self, sql: str, batch_size: int, interval: float,
+                 key: Optional[Callable[[tuple], Any]] = None):
+        self.sql = sql
+        self.batch_size = max(1, batch_size)
+        self.interval = interval
+        self.key = key
+        self._seq = 0
+        self._pending: Dict[Any, tuple] = {}
+        self._wakeup = asyncio.Event()
+        self._closing = False
+        self._task: Optional[asyncio.Task] = None
+
+    def add(self, row: tuple):
+        if self.key is None:
+            self._seq += 1
+            k = self._seq
+        else:
+            k = self.key(row)
+        self._pending[k] = row
+        if len(self._pending) >= self.batch_size:
+            self._wakeup.set()
+
+    async def flush(self) -> int:
+        if not self._pending:
+            return 0
+        batch, self._pending = self._pending, {}
+        try:
+            async with db.write(sql_label(self.sql)) as con:
+                await con.executemany(self.sql, list(batch.values()))
+        except Exception:
+            # أعد الدفعة للطابور كي لا تضيع (الأحدث يغلب)، وستُعاد المحاولة في الدورة التالية
+            batch.update(self._pending)
+            self._pending = batch
+            raise
+        return len(batch)
+
+    async def _run(self):
+        while not self._closing:
+            try:
+                await asyncio.wait_for(self._wakeup.wait(), self.interval)
+            except asyncio.TimeoutError:
+                pass
+            self._wakeup.clear()
+            try:
+                await self.flush()
+            except Exception:
+                log.exception("write-behind flush failed (%d pending)", len(self._pending))
+
+    def start(self):
+        if self._task is None:
+            self._closing = False
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        # تفريغ كامل قبل الإغلاق
+        if self._task is not None:
+            self._closing = True
+            self._wakeup.set()
+            await self._task
+            self._task = None
+        await self.flush()
+
+class PeriodicTask:
+    """يشغّل coroutine كل interval ثانية في الخلفية (أول تشغيل بعد delay)."""
+
+    def __init__(self, name: str, fn: Callable[[], Any], interval: float, delay: float = 0):
+        self.name = name
+        self.fn = fn
+        self.interval = interval
+        self.delay = delay
+        self._task: Optional[asyncio.Task] = None
+
+    async def _run(self):
+        await asyncio.sleep(self.delay)
+        while True:
+            try:
+                await self.fn()
+            except Exception:
+                log.exception("periodic task %s failed", self.name)
+            await asyncio.sleep(self.interval)
+
+    def start(self):
+        if self._task is None and self.interval > 0:
+            self._task = asyncio.create_task(self._run())
+
+    async def stop(self):
+        if self._task is not None:
+            self._task.cancel()
+            await asyncio.gather(self._task, return_exceptions=True)
+            self._task = None
+
+audit_log = WriteBehind(
+    "INSERT INTO logs(user_id, action, extra, created_at) VALUES(?,?,?,?)",
+    batch_size=LOG_BATCH_SIZE, interval=LOG_FLUSH_SECONDS,
+)
+
+# الـ WHERE يمنع تحديثاً فارغاً (وإعادة فهرسة FTS) إن لم يتغير شيء فعلاً
+user_upserts = WriteBehind("""
+    INSERT INTO users(user_id, username, first_name, last_name)
+    VALUES(?,?,?,?)
+    ON CONFLICT(user_id) DO UPDATE SET
+     username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name, reachable=1
+    WHERE username IS NOT excluded.username OR first_name IS NOT excluded.first_name
+       OR last_name IS NOT excluded.last_name OR reachable=0
+""", batch_size=500, interval=USER_FLUSH_SECONDS, key=lambda row: row[0])
+
+# (اليوم، المستخدم) لأول ظهور في اليوم؛ التكرار بين العمّال يمنعه PRIMARY KEY
+daily_activity = WriteBehind("INSERT OR IGNORE INTO daily_active(day, user_id) VALUES(?,?)",
+                             batch_size=500, interval=USER_FLUSH_SECONDS)
+
+async def flush_pending():
+    # قبل أي قراءة إدارية تحتاج رؤية آخر الكتابات المؤجلة
+    await user_upserts.flush()
+    await audit_log.flush()
+    await daily_activity.flush()
+
+async def recompute_counters(con: aiosqlite.Connection) -> Dict[str, tuple]:
+    """يعيد حساب العدادات من الصفر (مسح واحد لجدول users) ويعيد {الاسم: (المخزَّن، الفعلي)}."""
+    stored = dict(await con.execute_fetchall("SELECT name, value FROM counters"))
+    async with con.execute(
+        "SELECT COUNT(*), COALESCE(SUM(is_banned=1), 0), COALESCE(SUM(is_vip=1), 0), "
+        "COALESCE(SUM(reachable=0), 0) FROM users"
+    ) as cur:
+        total, banned, vip, unreachable = await cur.fetchone()
+    actual = {"users": total, "banned": banned, "vip": vip, "unreachable": unreachable}
+    await con.executemany(
+        "INSERT INTO counters(name, value) VALUES(?,?) ON CONFLICT(name) DO UPDATE SET value=excluded.value",
+        list(actual.items()))
+    return {name: (stored.get(name, 0), value) for name, value in actual.items()}
+
+async def backfill_rollups(con: aiosqlite.Connection) -> Dict[str, int]:
+    """يبني daily_joins من users ويكمّل daily_actions من السجلات الموجودة (النشاط اليومي لا يُستعاد)."""
+    await con.execute("DELETE FROM daily_joins")
+    await con.execute(
+        "INSERT INTO daily_joins(day, count) "
+        "SELECT COALESCE(date(joined_at), date('now')), COUNT(*) FROM users GROUP BY 1")
+    # MAX: أيام أُرشف جزء من سجلاتها تحتفظ بعددها الأكبر المحفوظ سابقاً
+    await con.execute(
+        "INSERT INTO daily_actions(day, action, user_id, count) "
+        "SELECT COALESCE(date(created_at), date('now')), COALESCE(action, ''), COALESCE(user_id, 0), COUNT(*) "
+        "FROM logs WHERE true GROUP BY 1, 2, 3 "
+        "ON CONFLICT(day, action, user_id) DO UPDATE SET count = MAX(count, excluded.count)")
+    return dict(await con.execute_fetchall(
+        "SELECT 'joins', COUNT(*) FROM daily_joins UNION ALL SELECT 'actions', COUNT(*) FROM daily_actions"))
 
 async def init_db():
-    async with await adb() as con:
+    async with aiosqlite.connect(DB_PATH) as con:
+        await con.execute("PRAGMA busy_timeout=5000")
+        existing = {name for (name,) in await con.execute_fetchall("SELECT name FROM sqlite_master")}
         await con.executescript(INIT_SQL)
+        await con.executescript(FTS_SQL)
+        if "users_fts" not in existing:
+            # أول تشغيل بعد إضافة الفهرس: بناؤه من الجدول الحالي
+            await con.execute("INSERT INTO users_fts(users_fts) VALUES('rebuild')")
+        columns = {row[1] for row in await con.execute_fetchall("PRAGMA table_info(users)")}
+        for column, ddl in USERS_MIGRATIONS.items():
+            if column not in columns:
+                await con.execute(ddl)
+        await con.executescript(AUDIENCE_SQL)
+        await con.executescript(COUNTERS_SQL)
+        if "counters" not in existing:
+            await recompute_counters(con)
+        await con.executescript(ROLLUPS_SQL)
+        if "daily_joins" not in existing:
+            # أول تشغيل بعد إضافة الإحصائيات اليومية: بناؤها من البيانات الحالية
+            await backfill_rollups(con)
+        if "accounts" not in existing and os.path.exists(ACCOUNTS_FILE):
+            with open(ACCOUNTS_FILE, "r", encoding="utf-8") as f:
+                legacy = json.load(f)
+            await con.executemany("INSERT OR IGNORE INTO accounts(kind, name) VALUES(?,?)",
+                                  [(kind, name) for kind, key in ACCOUNT_KINDS.items() for name in legacy.get(key, [])])
         # احفظ وضع الصيانة الافتراضي مرة واحدة
         cur = await con.execute("SELECT value FROM settings WHERE key='maintenance'")
         row = await cur.fetchone()
         if row is None:
             await con.execute("INSERT INTO settings(key,value) VALUES('maintenance', ?)", (json.dumps(MAINTENANCE_DEFAULT),))
         await con.commit()
+        cur = await con.execute("PRAGMA auto_vacuum")
+        if (await cur.fetchone())[0] != 2:
+            # مرة واحدة: تفعيل incremental_vacuum على قاعدة موجودة يتطلب VACUUM كاملاً
+            await con.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            await con.execute("VACUUM")
+
+@asynccontextmanager
+async def init_lock():
+    # uvicorn --workers N: كل عامل يمر بـ on_startup؛ القفل يجعل إنشاء الجداول والترحيلات تتم مرة واحدة بالتتابع
+    if fcntl is None:
+        yield
+        return
+    with open(os.path.join(DATA_DIR, ".init.lock"), "w") as fh:
+        # الانتظار على القفل في thread كي لا تتوقف حلقة الأحداث
+        await asyncio.to_thread(fcntl.flock, fh, fcntl.LOCK_EX)
+        try:
+            yield
+        finally:
+            fcntl.flock(fh, fcntl.LOCK_UN)
+
+async def prepare_db():
+    """ينشئ الجداول ويطبّق الترحيلات (مرة واحدة عبر العمّال) — قبل فتح اتصالات db."""
+    async with init_lock():
+        await init_db()
+
+# =========================
+# تعدد العمّال: leases في SQLite
+# =========================
+WORKER_ID = f"{socket.gethostname()}:{os.getpid()}"
+
+async def acquire_lease(name: str, ttl: float) -> bool:
+    """يأخذ (أو يجدد) قفلاً مؤقتاً مشتركاً بين العمّال؛ يفشل إن كان بيد عامل آخر ولم تنتهِ مدته."""
+    now = time.time()
+    async with db.write() as con:
+        cur = await con.execute("""
+          INSERT INTO leases(name, owner, expires_at) VALUES(?,?,?)
+          ON CONFLICT(name) DO UPDATE SET owner=excluded.owner, expires_at=excluded.expires_at
+          WHERE leases.expires_at < ? OR leases.owner = excluded.owner
+        """, (name, WORKER_ID, now + ttl, now))
+        return cur.rowcount > 0
+
+async def release_lease(name: str):
+    async with db.write() as con:
+        await con.execute("DELETE FROM leases WHERE name=? AND owner=?", (name, WORKER_ID))
 
-asyncio.get_event_loop().run_until_complete(init_db())
+# =========================
+# كاش الذاكرة (settings + المحظورون)
+# =========================
+# القراءة من الذاكرة فقط؛ كل كتابة تمر عبر set_maintenance/مسارات الحظر فتحدّث الكاش مباشرة
+SETTINGS: Dict[str, str] = {}
+BANNED_IDS: Set[int] = set()
+_caches_ready = False
+_cache_gens: Dict[str, int] = {}
+
+class LRU:
+    """قاموس محدود الحجم يطرد الأقدم استخداماً."""
+
+    def __init__(self, size: int):
+        self.size = max(1, size)
+        self._data: "OrderedDict[Any, Any]" = OrderedDict()
+
+    def __len__(self) -> int:
+        return len(self._data)
+
+    def get(self, key, default=None):
+        if key not in self._data:
+            return default
+        self._data.move_to_end(key)
+        return self._data[key]
+
+    def put(self, key, value):
+        self._data[key] = value
+        self._data.move_to_end(key)
+        if len(self._data) > self.size:
+            self._data.popitem(last=False)
+
+    def discard(self, key):
+        self._data.pop(key, None)
+
+# user_id -> بصمة (username, first_name, last_name): نكتب فقط للجديد أو المتغيّر
+user_profiles = LRU(USER_CACHE_SIZE)
+
+def profile_fp(username: Optional[str], first_name: Optional[str], last_name: Optional[str]) -> int:
+    return hash((username, first_name, last_name))
+
+async def warm_user_profiles():
+    # من لا يمكن الوصول إليهم لا تُحمّل بصماتهم: أول رسالة منهم تعيدهم reachable=1
+    rows = await db.fetchall("SELECT user_id, username, first_name, last_name FROM users WHERE reachable=1 LIMIT ?",
+                             (USER_CACHE_SIZE,))
+    for uid, un, fn, ln in rows:
+        user_profiles.put(uid, profile_fp(un, fn, ln))
+
+async def warm_caches(force: bool = False):
+    global _caches_ready, _unreachable_since
+    if _caches_ready and not force:
+        return
+    _cache_gens.update(await db.fetchall("SELECT name, value FROM counters WHERE name IN ('bans_gen', 'settings_gen', 'reach_gen')"))
+    await _load_settings()
+    await _load_banned()
+    _unreachable_since = utcnow_str()
+    _caches_ready = True
+
+async def _load_settings():
+    rows = await db.fetchall("SELECT key, value FROM settings")
+    SETTINGS.clear()
+    SETTINGS.update({k: v for k, v in rows})
+
+async def _load_banned():
+    banned = await db.fetchall("SELECT user_id FROM users WHERE is_banned=1")
+    BANNED_IDS.clear()
+    BANNED_IDS.update(uid for (uid,) in banned)
+
+# آخر last_error_at طُردت بصمته في هذا العامل
+_unreachable_since = ""
+
+async def _evict_unreachable():
+    global _unreachable_since
+    rows = await db.fetchall("SELECT user_id, last_error_at FROM users WHERE reachable=0 AND last_error_at >= ?",
+                             (_unreachable_since,))
+    for uid, at in rows:
+        user_profiles.discard(uid)
+        _unreachable_since = max(_unreachable_since, at or "")
+
+async def refresh_caches():
+    # قراءة صغيرة دورية: نعيد التحميل فقط إن غيّر عامل آخر (أو نحن) الحظر أو الإعدادات
+    gens = dict(await db.fetchall("SELECT name, value FROM counters WHERE name IN ('bans_gen', 'settings_gen', 'reach_gen')"))
+    if gens.get("settings_gen") != _cache_gens.get("settings_gen"):
+        await _load_settings()
+    if gens.get("bans_gen") != _cache_gens.get("bans_gen"):
+        await _load_banned()
+    if gens.get("reach_gen") != _cache_gens.get("reach_gen"):
+        await _evict_unreachable()
+    _cache_gens.update(gens)
 
 # =========================
 # أدوات
@@ -114,42 +898,695 @@ asyncio.get_event_loop().run_until_complete(init_db())
 def is_admin(user_id: int) -> bool:
     return user_id in ADMIN_IDS
 
+_active_day = ""
+_active_today: Set[int] = set()
+
+def mark_active(user_id: int):
+    # نكتب المستخدم مرة واحدة في اليوم لكل عامل
+    global _active_day
+    day = utcnow_str()[:10]
+    if day != _active_day:
+        _active_day = day
+        _active_today.clear()
+    if user_id not in _active_today:
+        _active_today.add(user_id)
+        daily_activity.add((day, user_id))
+
 async def ensure_user(update: Update):
     if not update.effective_user:
         return
     u = update.effective_user
-    async with await adb() as con:
-        await con.execute("""
-            INSERT INTO users(user_id, username, first_name, last_name)
-            VALUES(?,?,?,?)
-            ON CONFLICT(user_id) DO UPDATE SET
-             username=excluded.username, first_name=excluded.first_name, last_name=excluded.last_name
-        """, (u.id, u.username, u.first_name, u.last_name))
-        await con.commit()
+    mark_active(u.id)
+    fp = profile_fp(u.username, u.first_name, u.last_name)
+    if user_profiles.get(u.id) == fp:
+        return
+    user_profiles.put(u.id, fp)
+    user_upserts.add((u.id, u.username, u.first_name, u.last_name))
 
 async def user_is_banned(user_id: int) -> bool:
-    async with await adb() as con:
-        cur = await con.execute("SELECT is_banned FROM users WHERE user_id=?", (user_id,))
-        row = await cur.fetchone()
-    return bool(row and row[0] == 1)
+    await warm_caches()
+    return user_id in BANNED_IDS
+
+def utcnow_str() -> str:
+    # نفس صيغة CURRENT_TIMESTAMP في SQLite
+    return time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime())
 
 async def log_action(user_id: int, action: str, extra: Optional[str]=None):
-    async with await adb() as con:
-        await con.execute("INSERT INTO logs(user_id, action, extra) VALUES(?,?,?)",
-                          (user_id, action, extra))
-        await con.commit()
+    # لا ننتظر القرص: السطر يُكتب مع الدفعة التالية
+    audit_log.add((user_id, action, extra, utcnow_str()))
 
 async def get_maintenance() -> bool:
-    async with await adb() as con:
-        cur = await con.execute("SELECT value FROM settings WHERE key='maintenance'")
-        row = await cur.fetchone()
-    return bool(json.loads(row[0]) if row else False)
+    await warm_caches()
+    return bool(json.loads(SETTINGS.get("maintenance", "false")))
 
 async def set_maintenance(val: bool):
-    async with await adb() as con:
+    async with db.write() as con:
         await con.execute("INSERT INTO settings(key,value) VALUES('maintenance',?) ON CONFLICT(key) DO UPDATE SET value=excluded.value",
-                          ('maintenance', json.dumps(val)))
-        await con.commit()
+                          (json.dumps(val),))
+    SETTINGS["maintenance"] = json.dumps(val)
+
+# =========================
+# الإذاعة في الخلفية
+# =========================
+class TokenBucket:
+    """دلو رموز بسيط: rate رمز/ثانية بسعة burst، مع إمكانية إيقاف مؤقت (RetryAfter)."""
+
+    def __init__(self, rate: float, burst: float):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = burst
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+        self._lock = asyncio.Lock()
+
+    def _refill(self, now: float):
+        self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def try_acquire(self) -> bool:
+        now = time.monotonic()
+        self._refill(now)
+        if now < self.blocked_until or self.tokens < 1:
+            return False
+        self.tokens -= 1
+        return True
+
+    async def acquire(self):
+        async with self._lock:
+            while not self.try_acquire():
+                now = time.monotonic()
+                wait = max(self.blocked_until - now, (1 - self.tokens) / self.rate)
+                await asyncio.sleep(max(wait, 0.001))
+
+    def pause(self, seconds: float):
+        self.blocked_until = max(self.blocked_until, time.monotonic() + seconds)
+
+# أخطاء BadRequest تعني أن المحادثة لم تعد موجودة (وليست خطأً في الرسالة نفسها)
+DEAD_CHAT_ERRORS = ("chat not found", "user is deactivated", "bot was blocked", "peer_id_invalid")
+
+def is_dead_chat_error(message: str) -> bool:
+    message = message.lower()
+    return any(err in message for err in DEAD_CHAT_ERRORS)
+
+class Broadcaster:
+    """ينفّذ مهام الإذاعة كمهام خلفية قابلة للاستئناف؛ المؤشر والعدادات محفوظة في جدول broadcasts."""
+
+    def __init__(self, concurrency: int, rate: float, page: int, retries: int):
+        self.concurrency = max(1, concurrency)
+        self.page = max(1, page)
+        self.retries = retries
+        self.lease_ttl = 300
+        self.bucket = TokenBucket(rate, burst=max(1.0, rate))
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._live: Dict[int, Dict[str, int]] = {}
+        self._cancelled: Set[int] = set()
+
+    async def create(self, admin_id: int, text: str) -> int:
+        await flush_pending()
+        total = await db.fetchval("SELECT COUNT(*) FROM users WHERE is_banned=0 AND reachable=1", default=0)
+        async with db.write() as con:
+            cur = await con.execute("INSERT INTO broadcasts(admin_id, text, total) VALUES(?,?,?)",
+                                    (admin_id, text, total))
+            job_id = cur.lastrowid
+        if await acquire_lease(f"broadcast:{job_id}", self.lease_ttl):
+            self._spawn(job_id)
+        return job_id
+
+    async def resume(self):
+        # تُستدعى عند الإقلاع ودورياً: تلتقط المهام التي توقف عاملها (انتهت مدة الـ lease)
+        for (job_id,) in await db.fetchall("SELECT id FROM broadcasts WHERE status='running'"):
+            if job_id not in self._tasks and await acquire_lease(f"broadcast:{job_id}", self.lease_ttl):
+                self._spawn(job_id)
+
+    async def cancel(self, job_id: int) -> bool:
+        async with db.write() as con:
+            cur = await con.execute("UPDATE broadcasts SET status='cancelled', finished_at=CURRENT_TIMESTAMP "
+                                    "WHERE id=? AND status='running'", (job_id,))
+            changed = cur.rowcount > 0
+        if changed:
+            self._cancelled.add(job_id)
+        return changed
+
+    async def stop(self):
+        # المهام الجارية تُستأنف بعد إعادة التشغيل من آخر مؤشر محفوظ
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+    def progress(self, job_id: int) -> Optional[Dict[str, int]]:
+        return self._live.get(job_id)
+
+    def _spawn(self, job_id: int):
+        if job_id in self._tasks:
+            return
+        task = asyncio.create_task(self._run(job_id))
+        self._tasks[job_id] = task
+        task.add_done_callback(lambda _t: self._tasks.pop(job_id, None))
+
+    async def _send(self, bot, chat_id: int, text: str) -> Optional[str]:
+        """None = وصلت؛ وإلا سبب الفشل. الأسباب الدائمة تبدأ بـ "dead:"."""
+        error = "retries exhausted"
+        for attempt in range(self.retries + 1):
+            await self.bucket.acquire()
+            try:
+                await bot.send_message(chat_id=chat_id, text=text)
+                return None
+            except RetryAfter as e:
+                # حد عام من تيليجرام: أوقف كل المرسلين وليس هذا فقط
+                self.bucket.pause(float(e.retry_after) + 0.5)
+            except Forbidden as e:
+                return f"dead:{e.message}"
+            except BadRequest as e:
+                return f"dead:{e.message}" if is_dead_chat_error(e.message) else e.message
+            except NetworkError as e:
+                error = e.message
+                await asyncio.sleep(min(2 ** attempt, 30))
+            except TelegramError as e:
+                return e.message
+        return error
+
+    async def _run(self, job_id: int):
+        row = await db.fetchone("SELECT admin_id, text, cursor, sent, failed, status FROM broadcasts WHERE id=?", (job_id,))
+        if not row or row[5] != "running":
+            return
+        admin_id, text, cursor, sent, failed, _ = row
+        live = self._live[job_id] = {"sent": sent, "failed": failed, "dead": 0}
+        bot = application.bot
+        sem = asyncio.Semaphore(self.concurrency)
+        dead: List[tuple] = []
+
+        async def one(uid: int):
+            async with sem:
+                error = await self._send(bot, uid, text)
+                if error is None:
+                    live["sent"] += 1
+                    return
+                live["failed"] += 1
+                if error.startswith("dead:"):
+                    dead.append((error[5:][:200], utcnow_str(), uid))
+
+        try:
+            while job_id not in self._cancelled:
+                ids = [uid for (uid,) in await db.fetchall(
+                    "SELECT user_id FROM users WHERE is_banned=0 AND reachable=1 AND user_id>? ORDER BY user_id LIMIT ?",
+                    (cursor, self.page))]
+                if not ids:
+                    break
+                await asyncio.gather(*(one(uid) for uid in ids))
+                cursor = ids[-1]
+                async with db.write() as con:
+                    cur = await con.execute("UPDATE broadcasts SET cursor=?, sent=?, failed=? WHERE id=? AND status='running'",
+                                            (cursor, live["sent"], live["failed"], job_id))
+                    still_running = cur.rowcount > 0
+                    if dead:
+                        await con.executemany(
+                            "UPDATE users SET reachable=0, last_error=?, last_error_at=? WHERE user_id=?", dead)
+                if dead:
+                    for _err, _at, uid in dead:
+                        # عند عودته ستُكتب بصمته من جديد فيرجع reachable=1
+                        user_profiles.discard(uid)
+                    live["dead"] += len(dead)
+                    dead.clear()
+                # أُلغيت من عامل آخر أو انتقلت ملكيتها
+                if not still_running or not await acquire_lease(f"broadcast:{job_id}", self.lease_ttl):
+                    return
+            if job_id in self._cancelled:
+                return
+            async with db.write() as con:
+                await con.execute("UPDATE broadcasts SET status='done', finished_at=CURRENT_TIMESTAMP WHERE id=?", (job_id,))
+            await log_action(admin_id, "broadcast",
+                             f"id={job_id}, sent={live['sent']}, failed={live['failed']}, unreachable={live['dead']}")
+            try:
+                await bot.send_message(chat_id=admin_id,
+                                       text=f"تم الإرسال ✅ (#{job_id})\nنجح: {live['sent']} • فشل: {live['failed']}"
+                                            f"\n🚷 استُبعد من الإذاعات القادمة: {live['dead']}")
+            except TelegramError:
+                pass
+        except asyncio.CancelledError:
+            raise
+        except Exception:
+            log.exception("broadcast %s crashed; it will resume on next start", job_id)
+        finally:
+            self._cancelled.discard(job_id)
+            self._live.pop(job_id, None)
+            await release_lease(f"broadcast:{job_id}")
+
+broadcaster = Broadcaster(BROADCAST_CONCURRENCY, BROADCAST_RATE, BROADCAST_PAGE, BROADCAST_RETRIES)
+
+async def broadcast_status_text() -> str:
+    rows = await db.fetchall("""
+      SELECT id, status, total, sent, failed, created_at FROM broadcasts ORDER BY id DESC LIMIT 5
+    """)
+    if not rows:
+        return "لا توجد إذاعات بعد."
+    labels = {"running": "⏳ جارية", "done": "✅ انتهت", "cancelled": "⛔ أُلغيت"}
+    lines = ["📶 <b>حالة الإذاعة</b>"]
+    for job_id, status, total, sent, failed, created in rows:
+        live = broadcaster.progress(job_id)
+        if live:
+            sent, failed = live["sent"], live["failed"]
+        pct = int(100 * (sent + failed) / total) if total else 100
+        lines.append(f"• #{job_id} | {labels.get(status, status)} | {pct}% | "
+                     f"نجح: {sent} • فشل: {failed} • الكل: {total} | {created}")
+    return "\n".join(lines)
+
+def broadcast_status_kb():
+    rows = [
+        [InlineKeyboardButton("🔄 تحديث", callback_data="adm_bc_status"),
+         InlineKeyboardButton("⛔ إلغاء الجارية", callback_data="adm_bc_cancel")],
+        [InlineKeyboardButton("🔙 رجوع", callback_data="adm_refresh")]
+    ]
+    return InlineKeyboardMarkup(rows)
+
+# =========================
+# بحث المستخدمين
+# =========================
+USER_COLS = "u.user_id, u.username, u.first_name, u.last_name, u.is_banned, u.is_vip, u.joined_at"
+
+def user_line(r) -> str:
+    uid, un, fn, ln, banned, vip, joined = r
+    name = html.escape(f"{fn or ''} {ln or ''}")
+    return (f"• <b>{uid}</b> | @{html.escape(un or '-')} | {name} | "
+            f"{'🚫' if banned else '✅'} | {'💎' if vip else '—'} | {joined}")
+
+SQLITE_MAX_INT = 2 ** 63 - 1
+
+def like_escape(q: str) -> str:
+    return q.replace("\\", "\\\\").replace("%", "\\%").replace("_", "\\_")
+
+async def search_users(q: str, page: int):
+    """يعيد (الصفوف، هل توجد صفحة تالية). التطابق التام ثم البادئة (آيدي/يوزر) ثم ترتيب bm25."""
+    q = q.strip().lstrip("@")
+    if not q:
+        return [], False
+    limit, offset = SEARCH_PAGE + 1, page * SEARCH_PAGE
+    prefix = like_escape(q) + "%"
+    if len(q) >= 3:
+        rows = await db.fetchall(f"""
+          SELECT {USER_COLS}
+          FROM users_fts f JOIN users u ON u.user_id = f.rowid
+          WHERE users_fts MATCH ?
+          ORDER BY CASE
+                     WHEN CAST(u.user_id AS TEXT) = ? OR u.username = ? COLLATE NOCASE THEN 0
+                     WHEN CAST(u.user_id AS TEXT) LIKE ? ESCAPE '\\'
+                       OR u.username LIKE ? ESCAPE '\\' THEN 1
+                     ELSE 2
+                   END, f.rank
+          LIMIT ? OFFSET ?
+        """, ('"' + q.replace('"', '""') + '"', q, q, prefix, prefix, limit, offset))
+    else:
+        # أقصر من trigram: كل فرع بحث على فهرس، تُجمع بـ UNION ALL بترتيب الأولوية فيتوقف LIMIT مبكراً
+        by_id, by_username = "u.user_id", "u.username COLLATE NOCASE"
+        arms: List[Tuple[str, str, tuple]] = []
+        if q.isdigit():
+            arms.append(("u.user_id = ?", by_id, (int(q),)))
+        arms.append(("u.username = ? COLLATE NOCASE", by_username, (q,)))
+        if q.isdigit() and not q.startswith("0"):
+            # بادئة الآيدي = مجالات على المفتاح الأساسي: 12 → 120..129، 1200..1299، ...
+            for k in range(1, 20 - len(q)):
+                lo = int(q) * 10 ** k
+                if lo > SQLITE_MAX_INT:
+                    break
+                arms.append(("u.user_id BETWEEN ? AND ?", by_id, (lo, min(lo + 10 ** k - 1, SQLITE_MAX_INT))))
+        arms.append(("u.username LIKE ? ESCAPE '\\' AND u.username <> ? COLLATE NOCASE", by_username, (prefix, q)))
+        # الأسماء عبر فهارس NOCASE؛ نستبعد ما ظهر في فرع سابق
+        arms.append(("u.first_name LIKE ? ESCAPE '\\' AND NOT COALESCE(u.username LIKE ? ESCAPE '\\', 0)"
+                     " AND CAST(u.user_id AS TEXT) NOT LIKE ? ESCAPE '\\'",
+                     "u.first_name COLLATE NOCASE", (prefix, prefix, prefix)))
+        arms.append(("u.last_name LIKE ? ESCAPE '\\' AND NOT COALESCE(u.username LIKE ? ESCAPE '\\', 0)"
+                     " AND NOT COALESCE(u.first_name LIKE ? ESCAPE '\\', 0)"
+                     " AND CAST(u.user_id AS TEXT) NOT LIKE ? ESCAPE '\\'",
+                     "u.last_name COLLATE NOCASE", (prefix, prefix, prefix, prefix)))
+        sql = "\nUNION ALL\n".join(
+            f"SELECT * FROM (SELECT {USER_COLS} FROM users u WHERE {where} ORDER BY {order})"
+            for where, order, _ in arms)
+        params = tuple(p for _, _, ps in arms for p in ps)
+        rows = await db.fetchall(sql + "\nLIMIT ? OFFSET ?", params + (limit, offset))
+    return rows[:SEARCH_PAGE], len(rows) > SEARCH_PAGE
+
+async def search_page(q: str, page: int):
+    rows, has_more = await search_users(q, page)
+    if not rows:
+        text = "لا نتائج." if page == 0 else "لا مزيد من النتائج."
+    else:
+        text = "\n".join(user_line(r) for r in rows)
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"srch:{page - 1}"))
+    if has_more:
+        nav.append(InlineKeyboardButton("التالي ➡️", callback_data=f"srch:{page + 1}"))
+    rows_kb = [nav] if nav else []
+    rows_kb.append([InlineKeyboardButton("🔙 رجوع", callback_data="adm_refresh")])
+    return text, InlineKeyboardMarkup(rows_kb)
+
+# =========================
+# تصفّح المستخدمين والسجلات (keyset)
+# =========================
+# المؤشر يُحمل داخل callback_data: o = الأقدم من المفتاح، n = الأحدث منه
+async def users_page(direction: Optional[str], key: Optional[tuple]):
+    cols = USER_COLS.replace("u.", "")
+    if direction == "n":
+        rows = await db.fetchall(f"""
+          SELECT {cols} FROM users WHERE (joined_at, user_id) > (?, ?)
+          ORDER BY joined_at, user_id LIMIT ?
+        """, (*key, LIST_PAGE + 1))
+        more = len(rows) > LIST_PAGE
+        rows = rows[:LIST_PAGE][::-1]
+        return rows, True, more
+    if direction == "o":
+        rows = await db.fetchall(f"""
+          SELECT {cols} FROM users WHERE (joined_at, user_id) < (?, ?)
+          ORDER BY joined_at DESC, user_id DESC LIMIT ?
+        """, (*key, LIST_PAGE + 1))
+    else:
+        rows = await db.fetchall(f"""
+          SELECT {cols} FROM users ORDER BY joined_at DESC, user_id DESC LIMIT ?
+        """, (LIST_PAGE + 1,))
+    return rows[:LIST_PAGE], len(rows) > LIST_PAGE, direction == "o"
+
+async def logs_page(direction: Optional[str], key: Optional[int]):
+    cols = "id, user_id, action, extra, created_at"
+    if direction == "n":
+        rows = await db.fetchall(f"SELECT {cols} FROM logs WHERE id > ? ORDER BY id LIMIT ?", (key, LIST_PAGE + 1))
+        more = len(rows) > LIST_PAGE
+        return rows[:LIST_PAGE][::-1], True, more
+    if direction == "o":
+        rows = await db.fetchall(f"SELECT {cols} FROM logs WHERE id < ? ORDER BY id DESC LIMIT ?", (key, LIST_PAGE + 1))
+    else:
+        rows = await db.fetchall(f"SELECT {cols} FROM logs ORDER BY id DESC LIMIT ?", (LIST_PAGE + 1,))
+    return rows[:LIST_PAGE], len(rows) > LIST_PAGE, direction == "o"
+
+def pager_kb(prefix: str, newest_key: str, oldest_key: str, has_older: bool, has_newer: bool):
+    nav = []
+    if has_newer:
+        nav.append(InlineKeyboardButton("⬅️ الأحدث", callback_data=f"{prefix}:n:{newest_key}"))
+    if has_older:
+        nav.append(InlineKeyboardButton("الأقدم ➡️", callback_data=f"{prefix}:o:{oldest_key}"))
+    rows = [nav] if nav else []
+    rows.append([InlineKeyboardButton("🔙 رجوع", callback_data="adm_refresh")])
+    return InlineKeyboardMarkup(rows)
+
+# =========================
+# الحسابات (جدول accounts)
+# =========================
+async def add_account(kind: str, name: str) -> bool:
+    async with db.write() as con:
+        cur = await con.execute("INSERT OR IGNORE INTO accounts(kind, name) VALUES(?,?)", (kind, name))
+        return cur.rowcount > 0
+
+async def del_account(kind: str, name: str) -> bool:
+    async with db.write() as con:
+        cur = await con.execute("DELETE FROM accounts WHERE kind=? AND name=?", (kind, name))
+        return cur.rowcount > 0
+
+async def accounts_page(kind: str, page: int):
+    rows = await db.fetchall("SELECT name FROM accounts WHERE kind=? ORDER BY name LIMIT ? OFFSET ?",
+                             (kind, ACCOUNTS_PAGE + 1, page * ACCOUNTS_PAGE))
+    return [name for (name,) in rows[:ACCOUNTS_PAGE]], len(rows) > ACCOUNTS_PAGE
+
+# =========================
+# الإحصائيات اليومية (من جداول rollups فقط)
+# =========================
+def day_str(days_ago: int = 0) -> str:
+    return time.strftime("%Y-%m-%d", time.gmtime(time.time() - days_ago * 86400))
+
+async def stats_snapshot(days: int = 30) -> Dict[str, Any]:
+    """آخر days يوماً من الانضمام والنشاط والإجراءات + العدادات الكلية؛ كل استعلام محدود بنطاق أيام."""
+    since = day_str(max(1, days) - 1)
+    return {
+        "days": max(1, days),
+        "since": since,
+        "totals": dict(await db.fetchall("SELECT name, value FROM counters WHERE name IN ('users', 'banned', 'vip', 'unreachable')")),
+        "joins": dict(await db.fetchall("SELECT day, count FROM daily_joins WHERE day >= ? ORDER BY day", (since,))),
+        "dau": dict(await db.fetchall("SELECT day, count FROM daily_dau WHERE day >= ? ORDER BY day", (since,))),
+        "actions": [{"day": d, "action": a, "user_id": uid, "count": c} for d, a, uid, c in await db.fetchall(
+            "SELECT day, action, user_id, count FROM daily_actions WHERE day >= ? ORDER BY day", (since,))],
+    }
+
+def stats_text(snap: Dict[str, Any]) -> str:
+    totals, joins, dau = snap["totals"], snap["joins"], snap["dau"]
+    total, unreachable = totals.get("users", 0), totals.get("unreachable", 0)
+    today, yesterday = day_str(0), day_str(1)
+    week = {day_str(i) for i in range(7)}
+    joins_7 = sum(c for d, c in joins.items() if d in week)
+    dau_7 = [c for d, c in dau.items() if d in week]
+    by_action: Dict[str, int] = {}
+    by_admin: Dict[int, int] = {}
+    for row in snap["actions"]:
+        if row["day"] in week:
+            by_action[row["action"]] = by_action.get(row["action"], 0) + row["count"]
+            by_admin[row["user_id"]] = by_admin.get(row["user_id"], 0) + row["count"]
+    lines = [
+        "📊 <b>الإحصائيات</b>",
+        f"- المستخدمون: <b>{total}</b>",
+        f"- المحظورون: <b>{totals.get('banned', 0)}</b>",
+        f"- VIP: <b>{totals.get('vip', 0)}</b>",
+        f"- يمكن الوصول إليهم: <b>{total - unreachable}</b>",
+        f"- لا يمكن الوصول (حظروا البوت/حُذفوا): <b>{unreachable}</b>",
+        "",
+        "📈 <b>النمو</b>",
+        f"- انضموا اليوم: <b>{joins.get(today, 0)}</b> • أمس: <b>{joins.get(yesterday, 0)}</b>",
+        f"- آخر 7 أيام: <b>{joins_7}</b> • آخر {snap['days']} يوماً: <b>{sum(joins.values())}</b>",
+        f"- نشطون اليوم: <b>{dau.get(today, 0)}</b> • أمس: <b>{dau.get(yesterday, 0)}</b>"
+        f" • متوسط 7 أيام: <b>{round(sum(dau_7) / 7)}</b>",
+    ]
+    if by_action:
+        lines += ["", "🧾 <b>الإجراءات (7 أيام)</b>"]
+        lines += [f"- {html.escape(a)}: {c}" for a, c in sorted(by_action.items(), key=lambda kv: -kv[1])[:8]]
+        lines += [f"- الأدمن <code>{uid}</code>: {c}" for uid, c in sorted(by_admin.items(), key=lambda kv: -kv[1])[:5]]
+    return "\n".join(lines)
+
+# =========================
+# حظر/فك/VIP جماعي (معاملة واحدة)
+# =========================
+# الإجراء -> (العمود، القيمة الجديدة)؛ أسماء الأعمدة من هنا فقط وليست من المستخدم
+BULK_ACTIONS = {
+    "ban": ("is_banned", 1),
+    "unban": ("is_banned", 0),
+    "vip": ("is_vip", 1),
+    "unvip": ("is_vip", 0),
+}
+SQL_IN_CHUNK = 500
+
+def parse_ids(text: str):
+    """يستخرج الآيديات من نص (مسافات/أسطر/فواصل) بدون تكرار، ويعيد (الآيديات، الرموز غير الصالحة)."""
+    ids: Dict[int, None] = {}
+    invalid: List[str] = []
+    for token in re.split(r"[\s,;]+", text.strip()):
+        if not token:
+            continue
+        if token.lstrip("-").isdigit():
+            ids[int(token)] = None
+        else:
+            invalid.append(token)
+    return list(ids), invalid
+
+async def bulk_set_flag(action: str, ids: List[int]) -> Dict[str, List[int]]:
+    """يطبّق الإجراء على كل الآيديات في معاملة واحدة ويعيد {applied, unchanged, missing}."""
+    column, value = BULK_ACTIONS[action]
+    applied: List[int] = []
+    unchanged: List[int] = []
+    found: Set[int] = set()
+    async with db.write("bulk") as con:
+        for i in range(0, len(ids), SQL_IN_CHUNK):
+            chunk = ids[i:i + SQL_IN_CHUNK]
+            marks = ",".join("?" * len(chunk))
+            rows = await con.execute_fetchall(
+                f"SELECT user_id, {column} FROM users WHERE user_id IN ({marks})", chunk)
+            for uid, current in rows:
+                found.add(uid)
+                (unchanged if current == value else applied).append(uid)
+            await con.execute(
+                f"UPDATE users SET {column}=? WHERE {column} IS NOT ? AND user_id IN ({marks})",
+                (value, value, *chunk))
+    if column == "is_banned":
+        if value:
+            BANNED_IDS.update(applied)
+        else:
+            BANNED_IDS.difference_update(applied)
+    return {"applied": applied, "unchanged": unchanged, "missing": [uid for uid in ids if uid not in found]}
+
+def bulk_summary(action: str, result: Dict[str, List[int]], invalid: List[str]) -> str:
+    title = {"ban": "🚫 حظر", "unban": "✅ فك الحظر", "vip": "💎 منح VIP", "unvip": "إزالة VIP"}[action]
+    lines = [
+        f"{title}: انتهى",
+        f"- تم التطبيق: {len(result['applied'])}",
+        f"- بدون تغيير: {len(result['unchanged'])}",
+        f"- غير موجودين: {len(result['missing'])}",
+    ]
+    if invalid:
+        lines.append(f"- قيم غير صالحة: {len(invalid)}")
+    if result["missing"]:
+        shown = ", ".join(str(uid) for uid in result["missing"][:20])
+        more = len(result["missing"]) - 20
+        lines.append(f"\nغير موجودين: {shown}" + (f" (+{more})" if more > 0 else ""))
+    return "\n".join(lines)
+
+# =========================
+# النسخ الاحتياطي (يعمل في thread منفصل خارج حلقة الأحداث)
+# =========================
+BACKUP_TABLES = (
+    ("users.ndjson.gz", "users",
+     ("user_id", "username", "first_name", "last_name", "is_banned", "is_vip", "joined_at",
+      "reachable", "last_error", "last_error_at")),
+    ("logs.ndjson.gz", "logs",
+     ("id", "user_id", "action", "extra", "created_at")),
+)
+
+def _dump_ndjson_gz(con: sqlite3.Connection, table: str, cols: tuple, path: str):
+    # قراءة على دفعات من المؤشر: الذاكرة ثابتة مهما كبر الجدول
+    cur = con.execute(f"SELECT {', '.join(cols)} FROM {table}")
+    with gzip.open(path, "wt", encoding="utf-8") as f:
+        while True:
+            rows = cur.fetchmany(BACKUP_CHUNK)
+            if not rows:
+                break
+            f.writelines(json.dumps(dict(zip(cols, r)), ensure_ascii=False) + "\n" for r in rows)
+
+def _read_bytes(path: str) -> bytes:
+    with open(path, "rb") as f:
+        return f.read()
+
+def build_backup(with_snapshot: bool) -> str:
+    """ينشئ أرشيف tar واحداً: NDJSON مضغوط لكل جدول + الحسابات + (اختياري) لقطة .db عبر backup API."""
+    os.makedirs(BACKUP_DIR, exist_ok=True)
+    stamp = time.strftime("%Y%m%d-%H%M%S", time.gmtime())
+    # مجلد عمل فريد: نسختان في نفس الثانية لا تحذفان ملفات بعضهما
+    work = tempfile.mkdtemp(prefix="tmp-", dir=BACKUP_DIR)
+    members: List[str] = []
+    try:
+        src = sqlite3.connect(DB_PATH, isolation_level=None)
+        try:
+            # معاملة قراءة واحدة: users و logs من نفس اللحظة
+            src.execute("BEGIN")
+            for name, table, cols in BACKUP_TABLES:
+                path = os.path.join(work, name)
+                _dump_ndjson_gz(src, table, cols, path)
+                members.append(path)
+            accounts = {key: [] for key in ACCOUNT_KINDS.values()}
+            for kind, name in src.execute("SELECT kind, name FROM accounts ORDER BY kind, name"):
+                accounts.setdefault(ACCOUNT_KINDS.get(kind, kind), []).append(name)
+            src.execute("COMMIT")
+            if with_snapshot:
+                raw = os.path.join(work, "batman.db")
+                dst = sqlite3.connect(raw)
+                try:
+                    # خطوة واحدة: النسخ على دفعات يبدأ من جديد مع كل كتابة على المصدر
+                    src.backup(dst)
+                finally:
+                    dst.close()
+                with open(raw, "rb") as fin, gzip.open(raw + ".gz", "wb") as fout:
+                    shutil.copyfileobj(fin, fout)
+                os.remove(raw)
+                members.append(raw + ".gz")
+        finally:
+            src.close()
+        acc_path = os.path.join(work, "accounts.json")
+        with open(acc_path, "w", encoding="utf-8") as f:
+            json.dump(accounts, f, ensure_ascii=False, indent=2)
+        members.append(acc_path)
+
+        archive = os.path.join(BACKUP_DIR, f"{BOT_NAME.lower()}-backup-{stamp}.tar")
+        n = 1
+        while os.path.exists(archive):
+            archive = os.path.join(BACKUP_DIR, f"{BOT_NAME.lower()}-backup-{stamp}-{n}.tar")
+            n += 1
+        with tarfile.open(archive, "x") as tar:
+            for path in members:
+                tar.add(path, arcname=os.path.basename(path))
+    finally:
+        shutil.rmtree(work, ignore_errors=True)
+
+    # نحتفظ بآخر BACKUP_KEEP أرشيفات فقط
+    old = sorted(f for f in os.listdir(BACKUP_DIR) if f.endswith(".tar"))
+    for name in old[:-BACKUP_KEEP] if BACKUP_KEEP > 0 else []:
+        os.remove(os.path.join(BACKUP_DIR, name))
+    return archive
+
+# =========================
+# صيانة السجلّات وقاعدة البيانات
+# =========================
+def _append_archive(rows: List[tuple]):
+    # ملف شهري لكل مجموعة؛ gzip يسمح بإلحاق أعضاء جدد بنفس الملف
+    os.makedirs(ARCHIVE_DIR, exist_ok=True)
+    by_month: Dict[str, List[tuple]] = {}
+    for r in rows:
+        by_month.setdefault(str(r[4] or "unknown")[:7], []).append(r)
+    cols = ("id", "user_id", "action", "extra", "created_at")
+    for month, items in by_month.items():
+        with gzip.open(os.path.join(ARCHIVE_DIR, f"logs-{month}.ndjson.gz"), "at", encoding="utf-8") as f:
+            f.writelines(json.dumps(dict(zip(cols, r)), ensure_ascii=False) + "\n" for r in items)
+
+async def archive_old_logs() -> int:
+    """ينقل السجلات الأقدم من LOG_RETENTION_DAYS أو الزائدة عن LOG_MAX_ROWS إلى ملفات أرشيف شهرية."""
+    await audit_log.flush()
+    moved = 0
+    if LOG_RETENTION_DAYS > 0:
+        # بالتاريخ عبر idx_logs_created: لا نفترض أن id يتزايد مع created_at
+        cutoff = time.strftime("%Y-%m-%d %H:%M:%S", time.gmtime(time.time() - LOG_RETENTION_DAYS * 86400))
+        while True:
+            rows = await db.fetchall("""
+              SELECT id, user_id, action, extra, created_at FROM logs
+              WHERE created_at < ? ORDER BY created_at LIMIT ?
+            """, (cutoff, BACKUP_CHUNK))
+            if not rows:
+                break
+            await asyncio.to_thread(_append_archive, rows)
+            async with db.write() as con:
+                await con.executemany("DELETE FROM logs WHERE id=?", [(r[0],) for r in rows])
+            moved += len(rows)
+    upto = 0
+    if LOG_MAX_ROWS > 0:
+        upto = (await db.fetchval("SELECT MAX(id) FROM logs", default=0) or 0) - LOG_MAX_ROWS
+    last = 0
+    while last < upto:
+        rows = await db.fetchall("""
+          SELECT id, user_id, action, extra, created_at FROM logs
+          WHERE id > ? AND id <= ? ORDER BY id LIMIT ?
+        """, (last, upto, BACKUP_CHUNK))
+        if not rows:
+            break
+        await asyncio.to_thread(_append_archive, rows)
+        last = rows[-1][0]
+        async with db.write() as con:
+            await con.execute("DELETE FROM logs WHERE id <= ?", (last,))
+        moved += len(rows)
+    return moved
+
+async def housekeeping() -> Dict[str, Any]:
+    archived = await archive_old_logs()
+    async with db.write() as con:
+        await con.execute("DELETE FROM admin_state WHERE expires_at < ?", (time.time(),))
+        await con.execute("DELETE FROM leases WHERE expires_at < ?", (time.time(),))
+        # daily_dau يحتفظ بالعدد؛ صفوف المستخدمين تلزم لليوم الحالي فقط
+        await con.execute("DELETE FROM daily_active WHERE day < date('now', '-1 day')")
+    async with db.write() as con:
+        # executescript يكمل كل خطوات الـ pragma؛ execute يحرر صفحة واحدة فقط
+        await con.executescript("PRAGMA incremental_vacuum(2000);")
+        await con.execute("PRAGMA analysis_limit=1000")
+        await con.execute("ANALYZE")
+    async with db.write() as con:
+        async with con.execute("PRAGMA wal_checkpoint(TRUNCATE)") as cur:
+            busy, wal_pages, _ = await cur.fetchone()
+    report = {"archived": archived, "wal_pages": wal_pages, "checkpoint_busy": bool(busy)}
+    log.info("housekeeping: %s", report)
+    return report
+
+async def scheduled_housekeeping():
+    # عامل واحد فقط ينفّذ الصيانة في كل دورة
+    if await acquire_lease("housekeeping", HOUSEKEEPING_HOURS * 3600 / 2):
+        await housekeeping()
+
+housekeeper = PeriodicTask("housekeeping", scheduled_housekeeping, interval=HOUSEKEEPING_HOURS * 3600, delay=60)
+
+def backup_menu():
+    rows = [
+        [InlineKeyboardButton("📦 بيانات (NDJSON)", callback_data="adm_backup_run")],
+        [InlineKeyboardButton("🗄️ بيانات + لقطة قاعدة البيانات", callback_data="adm_backup_db")],
+        [InlineKeyboardButton("🔙 رجوع", callback_data="adm_refresh")]
+    ]
+    return InlineKeyboardMarkup(rows)
 
 # =========================
 # واجهة الأزرار
@@ -165,9 +1602,10 @@ def admin_panel():
         [InlineKeyboardButton("📊 الإحصائيات", callback_data="adm_stats"),
          InlineKeyboardButton("👥 المستخدمون", callback_data="adm_users")],
         [InlineKeyboardButton("📣 إذاعة", callback_data="adm_broadcast"),
-         InlineKeyboardButton("🔍 بحث", callback_data="adm_search")],
+         InlineKeyboardButton("📶 حالة الإذاعة", callback_data="adm_bc_status")],
+        [InlineKeyboardButton("🔍 بحث", callback_data="adm_search")],
         [InlineKeyboardButton("🚫 حظر/✅ فك", callback_data="adm_ban_menu"),
-         InlineKeyboardButton("💎 تبديل VIP", callback_data="adm_vip")],
+         InlineKeyboardButton("💎 VIP", callback_data="adm_vip_menu")],
         [InlineKeyboardButton("🧩 الحسابات", callback_data="adm_accounts"),
          InlineKeyboardButton("📝 السجلّات", callback_data="adm_logs")],
         [InlineKeyboardButton("🧰 نسخ احتياطي", callback_data="adm_backup"),
@@ -184,8 +1622,15 @@ def accounts_menu():
     ]
     return InlineKeyboardMarkup(rows)
 
-def list_accounts_kb(kind: str, items: List[str]):
+def list_accounts_kb(kind: str, items: List[str], page: int = 0, has_more: bool = False):
     rows = [[InlineKeyboardButton(f"• {item}", callback_data=f"noop")] for item in items] or [[InlineKeyboardButton("— لا يوجد —", callback_data="noop")]]
+    nav = []
+    if page > 0:
+        nav.append(InlineKeyboardButton("⬅️ السابق", callback_data=f"accp:{kind}:{page - 1}"))
+    if has_more:
+        nav.append(InlineKeyboardButton("التالي ➡️", callback_data=f"accp:{kind}:{page + 1}"))
+    if nav:
+        rows.append(nav)
     rows += [
         [InlineKeyboardButton("➕ إضافة", callback_data=f"acc_{kind}_add"),
          InlineKeyboardButton("➖ حذف", callback_data=f"acc_{kind}_del")],
@@ -193,12 +1638,58 @@ def list_accounts_kb(kind: str, items: List[str]):
     ]
     return InlineKeyboardMarkup(rows)
 
-# حالات مؤقتة للأدمن
-ADMIN_STATE: Dict[int, Dict[str, str]] = {}
+# حالات مؤقتة للأدمن (مع مدة صلاحية STATE_TTL)
+class MemoryState:
+    """حالات داخل ذاكرة العامل فقط: تصلح لعامل واحد."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+        self._data: Dict[int, tuple] = {}
+
+    async def get(self, user_id: int) -> Optional[Dict[str, str]]:
+        item = self._data.get(user_id)
+        if item is None:
+            return None
+        expires_at, value = item
+        if expires_at < time.time():
+            self._data.pop(user_id, None)
+            return None
+        return value
+
+    async def set(self, user_id: int, value: Dict[str, str]):
+        self._data[user_id] = (time.time() + self.ttl, value)
+
+    async def pop(self, user_id: int):
+        self._data.pop(user_id, None)
+
+class SQLiteState:
+    """حالات في جدول admin_state: يراها كل العمّال، والمنتهية تُحذف في مهمة الصيانة."""
+
+    def __init__(self, ttl: float):
+        self.ttl = ttl
+
+    async def get(self, user_id: int) -> Optional[Dict[str, str]]:
+        row = await db.fetchone("SELECT data FROM admin_state WHERE user_id=? AND expires_at >= ?",
+                                (user_id, time.time()))
+        return json.loads(row[0]) if row else None
+
+    async def set(self, user_id: int, value: Dict[str, str]):
+        async with db.write() as con:
+            await con.execute("""
+              INSERT INTO admin_state(user_id, data, expires_at) VALUES(?,?,?)
+              ON CONFLICT(user_id) DO UPDATE SET data=excluded.data, expires_at=excluded.expires_at
+            """, (user_id, json.dumps(value, ensure_ascii=False), time.time() + self.ttl))
+
+    async def pop(self, user_id: int):
+        async with db.write() as con:
+            await con.execute("DELETE FROM admin_state WHERE user_id=?", (user_id,))
+
+admin_state = SQLiteState(STATE_TTL) if STATE_BACKEND == "sqlite" else MemoryState(STATE_TTL)
 
 # =========================
 # الأوامر
 # =========================
+@timed_handler("start_cmd")
 async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await ensure_user(update)
     user = update.effective_user
@@ -222,6 +1713,7 @@ async def start_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
             f"مرحباً 👋\nأنا بوت {BOT_NAME} 🦇 — حارس الظلال هنا ✨"
         )
 
+@timed_handler("help_cmd")
 async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await update.effective_message.reply_text(
         "/start — بدء\n"
@@ -230,98 +1722,109 @@ async def help_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
         parse_mode=ParseMode.HTML
     )
 
+@timed_handler("id_cmd")
 async def id_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
     await update.effective_message.reply_text(f"🆔 آيديك: <code>{u.id}</code>", parse_mode=ParseMode.HTML)
 
+@timed_handler("reconcile_cmd")
+async def reconcile_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # للأدمن فقط: إعادة حساب العدادات وكشف أي انحراف
+    u = update.effective_user
+    if not u or not is_admin(u.id):
+        return
+    await flush_pending()
+    async with db.write() as con:
+        result = await recompute_counters(con)
+    lines = ["🧮 <b>مطابقة العدادات</b>"]
+    for name, (stored, actual) in result.items():
+        mark = "✅" if stored == actual else f"⚠️ انحراف {actual - stored:+d}"
+        lines.append(f"- {name}: {stored} → <b>{actual}</b> {mark}")
+    await update.effective_message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
+    drift = {name: actual - stored for name, (stored, actual) in result.items() if stored != actual}
+    await log_action(u.id, "reconcile_counters", json.dumps(drift) if drift else None)
+
+@timed_handler("housekeep_cmd")
+async def housekeep_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # للأدمن فقط: تشغيل الأرشفة والصيانة الآن
+    u = update.effective_user
+    if not u or not is_admin(u.id):
+        return
+    report = await housekeeping()
+    await update.effective_message.reply_text(
+        f"🧹 تمت الصيانة\n- سجلات مؤرشفة: {report['archived']}\n- صفحات WAL: {report['wal_pages']}"
+    )
+    await log_action(u.id, "housekeeping", f"archived={report['archived']}")
+
+@timed_handler("backfill_cmd")
+async def backfill_cmd(update: Update, context: ContextTypes.DEFAULT_TYPE):
+    # للأدمن فقط: إعادة بناء الإحصائيات اليومية من users/logs
+    u = update.effective_user
+    if not u or not is_admin(u.id):
+        return
+    await flush_pending()
+    async with db.write("backfill") as con:
+        sizes = await backfill_rollups(con)
+    await update.effective_message.reply_text(
+        f"📈 أُعيد بناء الإحصائيات اليومية\n- أيام الانضمام: {sizes['joins']}\n- صفوف الإجراءات: {sizes['actions']}"
+    )
+    await log_action(u.id, "backfill_rollups")
+
 # نصوص عامة (إن احتجناها لحالات الإذاعة/بحث)
+@timed_handler("text_handler")
 async def text_handler(update: Update, context: ContextTypes.DEFAULT_TYPE):
     user = update.effective_user
-    if not user:
+    if not user or not is_admin(user.id):
         return
-    state = ADMIN_STATE.get(user.id)
-    if not (state and is_admin(user.id)):
+    state = await admin_state.get(user.id)
+    if not state:
         return
 
     mode = state.get("mode")
+    HANDLER_LABEL.set(mode or "")
 
     # إذاعة
     if mode == "broadcast_wait":
         msg = update.effective_message.text or ""
-        sent, failed = 0, 0
-        async with await adb() as con:
-            cur = await con.execute("SELECT user_id FROM users WHERE is_banned=0")
-            rows = await cur.fetchall()
-        for (uid,) in rows:
-            try:
-                await context.bot.send_message(chat_id=uid, text=msg)
-                await asyncio.sleep(0.03)
-                sent += 1
-            except Exception:
-                failed += 1
-        ADMIN_STATE.pop(user.id, None)
-        await update.effective_message.reply_text(f"تم الإرسال ✅\nنجح: {sent} • فشل: {failed}")
-        await log_action(user.id, "broadcast", f"sent={sent}, failed={failed}")
+        await admin_state.pop(user.id)
+        job_id = await broadcaster.create(user.id, msg)
+        await update.effective_message.reply_text(
+            f"بدأت الإذاعة #{job_id} في الخلفية ⏳", reply_markup=broadcast_status_kb()
+        )
+        await log_action(user.id, "broadcast_start", f"id={job_id}")
         return
 
     # بحث
     if mode == "search_wait":
         q = (update.effective_message.text or "").strip()
-        async with await adb() as con:
-            cur = await con.execute("""
-              SELECT user_id, username, first_name, last_name, is_banned, is_vip, joined_at
-              FROM users
-              WHERE CAST(user_id AS TEXT) LIKE ?
-                 OR IFNULL(username,'') LIKE ?
-                 OR IFNULL(first_name,'') LIKE ?
-                 OR IFNULL(last_name,'') LIKE ?
-              LIMIT 30
-            """, (f"%{q}%", f"%{q}%", f"%{q}%", f"%{q}%"))
-            rows = await cur.fetchall()
-        if not rows:
-            await update.effective_message.reply_text("لا نتائج.")
-        else:
-            lines = []
-            for r in rows:
-                uid, un, fn, ln, banned, vip, joined = r
-                lines.append(
-                    f"• <b>{uid}</b> | @{un or '-'} | {fn or ''} {ln or ''} | "
-                    f"{'🚫' if banned else '✅'} | {'💎' if vip else '—'} | {joined}"
-                )
-            await update.effective_message.reply_text("\n".join(lines), parse_mode=ParseMode.HTML)
-        ADMIN_STATE.pop(user.id, None)
+        await flush_pending()
+        text, kb = await search_page(q, 0)
+        await update.effective_message.reply_text(text, parse_mode=ParseMode.HTML, reply_markup=kb)
+        # نحتفظ بالكلمة لأزرار التنقل بين الصفحات
+        await admin_state.set(user.id, {"mode": "search_view", "q": q})
         return
 
     # إضافة/حذف حساب
     if mode in ("add_insta", "add_tg", "del_insta", "del_tg"):
         name = (update.effective_message.text or "").strip()
-        global instagram_accounts, telegram_accounts
+        action, kind = mode.split("_", 1)
         changed = False
-
-        if mode == "add_insta" and name:
-            if name not in instagram_accounts:
-                instagram_accounts.append(name); changed=True
-        elif mode == "add_tg" and name:
-            if name not in telegram_accounts:
-                telegram_accounts.append(name); changed=True
-        elif mode == "del_insta":
-            if name in instagram_accounts:
-                instagram_accounts = [x for x in instagram_accounts if x != name]; changed=True
-        elif mode == "del_tg":
-            if name in telegram_accounts:
-                telegram_accounts = [x for x in telegram_accounts if x != name]; changed=True
+        if action == "add" and name:
+            changed = await add_account(kind, name)
+        elif action == "del" and name:
+            changed = await del_account(kind, name)
 
         if changed:
-            save_accounts(instagram_accounts, telegram_accounts)
             await update.effective_message.reply_text("تم الحفظ ✅", reply_markup=admin_panel())
             await log_action(user.id, "accounts_update", f"mode={mode}, name={name}")
         else:
             await update.effective_message.reply_text("لم يحدث تغيير.")
 
-        ADMIN_STATE.pop(user.id, None)
+        await admin_state.pop(user.id)
         return
 
 # كول باك للأزرار
+@timed_handler("admin_cb", label=callback_label)
 async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     q = update.callback_query
     u = update.effective_user
@@ -340,41 +1843,53 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await q.edit_message_reply_markup(reply_markup=admin_panel()); return
 
     if data == "adm_stats":
-        async with await adb() as con:
-            total = (await (await con.execute("SELECT COUNT(*) FROM users")).fetchone())[0]
-            banned = (await (await con.execute("SELECT COUNT(*) FROM users WHERE is_banned=1")).fetchone())[0]
-            vip = (await (await con.execute("SELECT COUNT(*) FROM users WHERE is_vip=1")).fetchone())[0]
-        await q.edit_message_text(
-            f"📊 <b>الإحصائيات</b>\n- المستخدمون: <b>{total}</b>\n- المحظورون: <b>{banned}</b>\n- VIP: <b>{vip}</b>",
-            parse_mode=ParseMode.HTML, reply_markup=admin_panel()
-        )
+        await flush_pending()
+        await q.edit_message_text(stats_text(await stats_snapshot(30)),
+                                  parse_mode=ParseMode.HTML, reply_markup=admin_panel())
         await log_action(u.id, "stats"); return
 
-    if data == "adm_users":
-        async with await adb() as con:
-            cur = await con.execute("""
-              SELECT user_id, username, first_name, last_name, is_banned, is_vip, joined_at
-              FROM users ORDER BY joined_at DESC LIMIT 20
-            """); rows = await cur.fetchall()
+    if data == "adm_users" or data.startswith("usr:"):
+        direction, key = None, None
+        if data == "adm_users":
+            await flush_pending()
+        else:
+            _, direction, raw = data.split(":", 2)
+            joined, uid = raw.rsplit("|", 1)
+            key = (joined, int(uid))
+        rows, has_older, has_newer = await users_page(direction, key)
         if not rows:
             await q.edit_message_text("لا يوجد مستخدمون بعد.", reply_markup=admin_panel()); return
-        lines = []
-        for r in rows:
-            uid, un, fn, ln, banned, vip, joined = r
-            lines.append(
-                f"• <b>{uid}</b> | @{un or '-'} | {fn or ''} {ln or ''} | "
-                f"{'🚫' if banned else '✅'} | {'💎' if vip else '—'} | {joined}"
-            )
-        await q.edit_message_text("\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=admin_panel()); return
+        lines = [user_line(r) for r in rows]
+        kb = pager_kb("usr", f"{rows[0][6]}|{rows[0][0]}", f"{rows[-1][6]}|{rows[-1][0]}", has_older, has_newer)
+        await q.edit_message_text("\n".join(lines), parse_mode=ParseMode.HTML, reply_markup=kb); return
 
     if data == "adm_broadcast":
-        ADMIN_STATE[u.id] = {"mode": "broadcast_wait"}
+        await admin_state.set(u.id, {"mode": "broadcast_wait"})
         await q.edit_message_text("أرسل نص الإذاعة الآن…", reply_markup=admin_panel()); return
 
+    if data == "adm_bc_status":
+        await q.edit_message_text(await broadcast_status_text(), parse_mode=ParseMode.HTML,
+                                  reply_markup=broadcast_status_kb()); return
+
+    if data == "adm_bc_cancel":
+        running = await db.fetchall("SELECT id FROM broadcasts WHERE status='running'")
+        for (job_id,) in running:
+            await broadcaster.cancel(job_id)
+            await log_action(u.id, "broadcast_cancel", f"id={job_id}")
+        await q.edit_message_text(await broadcast_status_text(), parse_mode=ParseMode.HTML,
+                                  reply_markup=broadcast_status_kb()); return
+
     if data == "adm_search":
-        ADMIN_STATE[u.id] = {"mode": "search_wait"}
+        await admin_state.set(u.id, {"mode": "search_wait"})
         await q.edit_message_text("أرسل كلمة البحث (آيدي/يوزر/اسم)…", reply_markup=admin_panel()); return
 
+    if data.startswith("srch:"):
+        state = await admin_state.get(u.id) or {}
+        if state.get("mode") != "search_view":
+            await q.edit_message_text("انتهت جلسة البحث، ابدأ بحثاً جديداً.", reply_markup=admin_panel()); return
+        text, kb = await search_page(state["q"], int(data.split(":", 1)[1]))
+        await q.edit_message_text(text, parse_mode=ParseMode.HTML, reply_markup=kb); return
+
     if data == "adm_ban_menu":
         kb = InlineKeyboardMarkup([
             [InlineKeyboardButton("🚫 حظر مستخدم", callback_data="adm_ban")],
@@ -383,65 +1898,86 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
         ])
         await q.edit_message_text("اختر الإجراء:", reply_markup=kb); return
 
-    if data in ("adm_ban", "adm_unban", "adm_vip"):
-        mode = {"adm_ban": "ban", "adm_unban": "unban", "adm_vip": "vip"}[data]
-        ADMIN_STATE[u.id] = {"mode": f"{mode}_wait"}
-        await q.edit_message_text("أرسل آيدي المستخدم:", reply_markup=admin_panel()); return
+    if data == "adm_vip_menu":
+        kb = InlineKeyboardMarkup([
+            [InlineKeyboardButton("💎 منح VIP", callback_data="adm_vip")],
+            [InlineKeyboardButton("إزالة VIP", callback_data="adm_unvip")],
+            [InlineKeyboardButton("🔙 رجوع", callback_data="adm_refresh")]
+        ])
+        await q.edit_message_text("اختر الإجراء:", reply_markup=kb); return
+
+    if data in ("adm_ban", "adm_unban", "adm_vip", "adm_unvip"):
+        await admin_state.set(u.id, {"mode": f"{data[4:]}_wait"})
+        await q.edit_message_text(
+            "أرسل آيدي المستخدم، أو عدة آيديات مفصولة بمسافات/أسطر، أو ملفاً نصياً بها:",
+            reply_markup=admin_panel()); return
 
-    if data == "adm_logs":
-        async with await adb() as con:
-            cur = await con.execute("SELECT user_id, action, extra, created_at FROM logs ORDER BY id DESC LIMIT 20")
-            rows = await cur.fetchall()
+    if data == "adm_logs" or data.startswith("lg:"):
+        direction, key = None, None
+        if data == "adm_logs":
+            await flush_pending()
+        else:
+            _, direction, raw = data.split(":", 2)
+            key = int(raw)
+        rows, has_older, has_newer = await logs_page(direction, key)
         if not rows:
             await q.edit_message_text("لا توجد سجلات بعد.", reply_markup=admin_panel()); return
-        lines = [f"• {t} | {act} | by {uid} | {extra or ''}" for uid, act, extra, t in rows]
-        await q.edit_message_text("\n".join(lines), reply_markup=admin_panel()); return
+        lines = [f"• {t} | {act} | by {uid} | {extra or ''}" for _id, uid, act, extra, t in rows]
+        kb = pager_kb("lg", str(rows[0][0]), str(rows[-1][0]), has_older, has_newer)
+        await q.edit_message_text("\n".join(lines), reply_markup=kb); return
 
     if data == "adm_accounts":
         await q.edit_message_text("اختر نوع الحساب:", reply_markup=accounts_menu()); return
 
-    if data in ("acc_insta", "acc_tg"):
-        kind = "insta" if data == "acc_insta" else "tg"
-        items = instagram_accounts if kind == "insta" else telegram_accounts
+    if data in ("acc_insta", "acc_tg") or data.startswith("accp:"):
+        if data.startswith("accp:"):
+            _, kind, page = data.split(":")
+            page = int(page)
+        else:
+            kind, page = ("insta" if data == "acc_insta" else "tg"), 0
+        items, has_more = await accounts_page(kind, page)
         title = "📸 إنستغرام" if kind == "insta" else "💬 تيليجرام"
-        await q.edit_message_text(f"{title}:", reply_markup=list_accounts_kb(kind, items)); return
+        await q.edit_message_text(f"{title}:", reply_markup=list_accounts_kb(kind, items, page, has_more)); return
 
     if data in ("acc_insta_add", "acc_tg_add", "acc_insta_del", "acc_tg_del"):
         mode = data.replace("acc_", "").replace("_add", "").replace("_del", "")
         # mode: insta / tg  + implicit add/del
         if data.endswith("_add"):
-            ADMIN_STATE[u.id] = {"mode": f"add_{mode}"}
+            await admin_state.set(u.id, {"mode": f"add_{mode}"})
             await q.edit_message_text("أرسل اسم/معرّف الحساب لإضافته:", reply_markup=admin_panel()); return
         else:
-            ADMIN_STATE[u.id] = {"mode": f"del_{mode}"}
+            await admin_state.set(u.id, {"mode": f"del_{mode}"})
             await q.edit_message_text("أرسل الاسم/المعرّف لحذفه:", reply_markup=admin_panel()); return
 
     if data == "adm_backup":
-        # تصدير users & logs & accounts كملفات
-        # users.json
-        async with await adb() as con:
-            cur = await con.execute("SELECT user_id, username, first_name, last_name, is_banned, is_vip, joined_at FROM users")
-            users_rows = await cur.fetchall()
-            cur = await con.execute("SELECT id, user_id, action, extra, created_at FROM logs ORDER BY id DESC")
-            logs_rows = await cur.fetchall()
-        users_list = [dict(user_id=r[0], username=r[1], first_name=r[2], last_name=r[3],
-                           is_banned=r[4], is_vip=r[5], joined_at=r[6]) for r in users_rows]
-        logs_list = [dict(id=r[0], user_id=r[1], action=r[2], extra=r[3], created_at=r[4]) for r in logs_rows]
-
-        users_path = os.path.join(DATA_DIR, "users_export.json")
-        logs_path = os.path.join(DATA_DIR, "logs_export.json")
-        acc_path = os.path.join(DATA_DIR, "accounts_export.json")
-
-        with open(users_path, "w", encoding="utf-8") as f: json.dump(users_list, f, ensure_ascii=False, indent=2)
-        with open(logs_path, "w", encoding="utf-8") as f: json.dump(logs_list, f, ensure_ascii=False, indent=2)
-        with open(acc_path, "w", encoding="utf-8") as f:
-            json.dump({"instagram": instagram_accounts, "telegram": telegram_accounts}, f, ensure_ascii=False, indent=2)
-
-        await context.bot.send_document(chat_id=u.id, document=InputFile(users_path))
-        await context.bot.send_document(chat_id=u.id, document=InputFile(logs_path))
-        await context.bot.send_document(chat_id=u.id, document=InputFile(acc_path))
-        await q.edit_message_text("تم إرسال ملفات النسخ الاحتياطي ✅", reply_markup=admin_panel())
-        await log_action(u.id, "backup"); return
+        await q.edit_message_text("اختر نوع النسخة الاحتياطية:", reply_markup=backup_menu()); return
+
+    if data in ("adm_backup_run", "adm_backup_db"):
+        with_snapshot = data == "adm_backup_db"
+        await q.edit_message_text("⏳ جارٍ تجهيز النسخة الاحتياطية…")
+        await flush_pending()
+        try:
+            archive = await asyncio.to_thread(build_backup, with_snapshot)
+        except Exception as e:
+            log.exception("backup failed")
+            await q.edit_message_text(f"فشل إنشاء النسخة الاحتياطية ❌\n{e}", reply_markup=admin_panel()); return
+        size = os.path.getsize(archive)
+        if size > BACKUP_SEND_MAX_BYTES:
+            await q.edit_message_text(
+                f"النسخة أكبر من حد الإرسال ({size // (1024 * 1024)} MB)، محفوظة على الخادم:\n<code>{html.escape(archive)}</code>",
+                reply_markup=admin_panel(), parse_mode=ParseMode.HTML)
+        else:
+            # القراءة خارج حلقة الأحداث: InputFile يقرأ كائن الملف بشكل متزامن
+            payload = await asyncio.to_thread(_read_bytes, archive)
+            try:
+                await context.bot.send_document(chat_id=u.id, document=InputFile(payload, filename=os.path.basename(archive)))
+            except TelegramError as e:
+                await q.edit_message_text(
+                    f"تعذّر إرسال الملف ({e.message})، محفوظ على الخادم:\n<code>{html.escape(archive)}</code>",
+                    reply_markup=admin_panel(), parse_mode=ParseMode.HTML)
+            else:
+                await q.edit_message_text("تم إرسال ملف النسخ الاحتياطي ✅", reply_markup=admin_panel())
+        await log_action(u.id, "backup", f"snapshot={with_snapshot} size={size}"); return
 
     if data == "adm_toggle_maint":
         val = not (await get_maintenance())
@@ -453,54 +1989,45 @@ async def admin_cb(update: Update, context: ContextTypes.DEFAULT_TYPE):
     if data == "noop":
         return
 
-# أوضاع إدخال آيدي للحظر/فك/VIP
+# أوضاع إدخال آيدي (أو عدة آيديات/ملف) للحظر/فك/VIP
+@timed_handler("admin_text_modes")
 async def admin_text_modes(update: Update, context: ContextTypes.DEFAULT_TYPE):
     u = update.effective_user
     if not u or not is_admin(u.id):
         return
-    state = ADMIN_STATE.get(u.id)
+    state = await admin_state.get(u.id)
     if not state:
         return
     mode = state.get("mode")
-    if mode not in ("ban_wait", "unban_wait", "vip_wait"):
+    action = mode[:-5] if mode and mode.endswith("_wait") else None
+    if action not in BULK_ACTIONS:
         return
+    HANDLER_LABEL.set(mode)
+    msg = update.effective_message
 
-    raw = (update.effective_message.text or "").strip()
-    try:
-        target_id = int(raw)
-    except ValueError:
-        await update.effective_message.reply_text("أدخل آيدي رقمي صحيح.")
-        return
-
-    async with await adb() as con:
-        cur = await con.execute("SELECT user_id FROM users WHERE user_id=?", (target_id,))
-        exists = await cur.fetchone()
-
-    if not exists:
-        await update.effective_message.reply_text("المستخدم غير موجود بقاعدة البيانات.")
-        ADMIN_STATE.pop(u.id, None); return
-
-    if mode == "ban_wait":
-        async with await adb() as con:
-            await con.execute("UPDATE users SET is_banned=1 WHERE user_id=?", (target_id,))
-            await con.commit()
-        await update.effective_message.reply_text("تم الحظر 🚫"); await log_action(u.id, "ban", f"target={target_id}")
-
-    elif mode == "unban_wait":
-        async with await adb() as con:
-            await con.execute("UPDATE users SET is_banned=0 WHERE user_id=?", (target_id,))
-            await con.commit()
-        await update.effective_message.reply_text("تم فك الحظر ✅"); await log_action(u.id, "unban", f"target={target_id}")
+    if msg.document:
+        if (msg.document.file_size or 0) > BULK_FILE_MAX_BYTES:
+            await msg.reply_text(f"الملف أكبر من الحد المسموح ({BULK_FILE_MAX_BYTES // 1024} KB).")
+            return
+        data = await (await msg.document.get_file()).download_as_bytearray()
+        raw = data.decode("utf-8", errors="replace")
+    else:
+        raw = msg.text or ""
 
-    else:  # vip_wait
-        async with await adb() as con:
-            await con.execute("UPDATE users SET is_vip = CASE WHEN is_vip=1 THEN 0 ELSE 1 END WHERE user_id=?", (target_id,))
-            await con.commit()
-            (new_vip,) = await (await con.execute("SELECT is_vip FROM users WHERE user_id=?", (target_id,))).fetchone()
-        await update.effective_message.reply_text(f"تم التبديل: {'💎 VIP' if new_vip else 'غير VIP'}")
-        await log_action(u.id, "toggle_vip", f"target={target_id}")
+    ids, invalid = parse_ids(raw)
+    if not ids:
+        await msg.reply_text("أدخل آيدي رقمي صحيح.")
+        return
+    if len(ids) > BULK_MAX_IDS:
+        await msg.reply_text(f"الحد الأقصى {BULK_MAX_IDS} آيدي في المرة الواحدة.")
+        return
 
-    ADMIN_STATE.pop(u.id, None)
+    await flush_pending()
+    result = await bulk_set_flag(action, ids)
+    for target_id in result["applied"]:
+        await log_action(u.id, action, f"target={target_id}")
+    await admin_state.pop(u.id)
+    await msg.reply_text(bulk_summary(action, result, invalid), reply_markup=admin_panel())
 
 # =========================
 # ربط الهاندلرز
@@ -508,36 +2035,400 @@ async def admin_text_modes(update: Update, context: ContextTypes.DEFAULT_TYPE):
 application.add_handler(CommandHandler("start", start_cmd))
 application.add_handler(CommandHandler("help", help_cmd))
 application.add_handler(CommandHandler("id", id_cmd))
+application.add_handler(CommandHandler("reconcile", reconcile_cmd))
+application.add_handler(CommandHandler("housekeep", housekeep_cmd))
+application.add_handler(CommandHandler("backfill", backfill_cmd))
 application.add_handler(CallbackQueryHandler(admin_cb))
 application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, text_handler))
-application.add_handler(MessageHandler(filters.TEXT & ~filters.COMMAND, admin_text_modes))
+# مجموعة منفصلة: الهاندلر الأول المطابق في نفس المجموعة يمنع ما بعده
+application.add_handler(MessageHandler((filters.TEXT & ~filters.COMMAND) | filters.Document.ALL, admin_text_modes), group=1)
 
 # =========================
 # Webhook: FastAPI
 # =========================
+def update_chat_id(data: dict) -> Optional[int]:
+    msg = data.get("message") or data.get("edited_message")
+    if msg:
+        return (msg.get("chat") or {}).get("id")
+    cq = data.get("callback_query")
+    if cq:
+        return ((cq.get("message") or {}).get("chat") or {}).get("id") or (cq.get("from") or {}).get("id")
+    return None
+
+UPDATE_ID_RE = re.compile(rb'"update_id"\s*:\s*(\d+)')
+
+class UpdateDedup:
+    """يمنع معالجة نفس update_id مرتين: نافذة محدودة في الذاكرة (بلا قاعدة)، ثم حجز في جدول seen_updates
+    المشترك بين العمّال للتحديثات التي ستُعالج فعلاً فقط، + حدّ أعلى محفوظ في counters لما بعد إعادة التشغيل."""
+
+    def __init__(self, window: int):
+        self.window = max(1, window)
+        self._seen: Set[int] = set()
+        self._order: "OrderedDict[int, None]" = OrderedDict()
+        self._inflight: Set[int] = set()
+        self._claimed: Set[int] = set()
+        self.floor = 0  # كل ما دونه (أو يساويه) يُعدّ مكرراً
+        self.high = 0
+        self._saved = 0
+
+    async def load(self):
+        self.floor = self._saved = self.high = int(await db.fetchval(
+            "SELECT value FROM counters WHERE name='update_hwm'") or 0)
+
+    def begin(self, update_id: int) -> bool:
+        """يحجز التحديث محلياً (في الذاكرة فقط)؛ False إن كان مكرراً في هذا العامل."""
+        if update_id <= self.floor or update_id in self._seen:
+            return False
+        self._seen.add(update_id)
+        self._order[update_id] = None
+        self._inflight.add(update_id)
+        if len(self._order) > self.window:
+            old, _ = self._order.popitem(last=False)
+            self._seen.discard(old)
+            self.floor = max(self.floor, old)
+        return True
+
+    async def claim(self, update_id: int) -> bool:
+        """الحجز المشترك قبل المعالجة مباشرة: إعادة الإرسال قد تصل لعامل آخر. False إن سبقنا إليه عامل آخر."""
+        async with db.write("dedup") as con:
+            cur = await con.execute("INSERT OR IGNORE INTO seen_updates(update_id, seen_at) VALUES(?,?)",
+                                    (update_id, time.time()))
+            claimed = cur.rowcount > 0
+        if claimed:
+            self._claimed.add(update_id)
+        return claimed
+
+    async def done(self, update_id: int, ok: bool = True):
+        self._inflight.discard(update_id)
+        claimed = update_id in self._claimed
+        self._claimed.discard(update_id)
+        if ok:
+            self.high = max(self.high, update_id)
+            return
+        # فشلت المعالجة أو رُفض التحديث مؤقتاً: نسمح لإعادة تيليجرام بالمرور (في أي عامل)
+        self._seen.discard(update_id)
+        self._order.pop(update_id, None)
+        if claimed:
+            async with db.write("dedup") as con:
+                await con.execute("DELETE FROM seen_updates WHERE update_id=?", (update_id,))
+
+    def watermark(self) -> int:
+        # لا نحفظ ما تجاوز أقدم تحديث لم تكتمل معالجته بعد
+        return min(self._inflight) - 1 if self._inflight else self.high
+
+    async def persist(self):
+        mark = self.watermark()
+        if mark <= self._saved:
+            return
+        async with db.write("dedup") as con:
+            await con.execute("UPDATE counters SET value = MAX(value, ?) WHERE name='update_hwm'", (mark,))
+            # ما دون النافذة يرفضه الحد الأعلى وحده
+            await con.execute("DELETE FROM seen_updates WHERE update_id <= ?", (mark - self.window,))
+        self._saved = mark
+
+update_dedup = UpdateDedup(DEDUP_WINDOW)
+
+def update_user_id(data: dict) -> Optional[int]:
+    for key in ("message", "edited_message", "callback_query"):
+        obj = data.get(key)
+        if obj:
+            return (obj.get("from") or {}).get("id")
+    return None
+
+class FloodGuard:
+    """حماية قبل أي عمل على القاعدة (بما فيه حجز seen_updates المشترك): دلو رموز لكل مستخدم + حد عام للتحديثات قيد المعالجة (الأدمن مستثنى)."""
+
+    def __init__(self, rate: float, burst: float, users: int, max_inflight: int):
+        self.rate = rate
+        self.burst = max(1.0, burst)
+        self.max_inflight = max_inflight
+        self.inflight = 0
+        self._buckets = LRU(users)
+
+    def allow(self, user_id: Optional[int]) -> bool:
+        if user_id is None or is_admin(user_id) or self.rate <= 0:
+            return True
+        bucket = self._buckets.get(user_id)
+        if bucket is None:
+            bucket = TokenBucket(self.rate, self.burst)
+            self._buckets.put(user_id, bucket)
+        return bucket.try_acquire()
+
+    def enter(self, user_id: Optional[int]) -> bool:
+        if self.max_inflight > 0 and self.inflight >= self.max_inflight and not (user_id is not None and is_admin(user_id)):
+            return False
+        self.inflight += 1
+        return True
+
+    def leave(self):
+        self.inflight -= 1
+
+flood_guard = FloodGuard(FLOOD_RATE, FLOOD_BURST, FLOOD_USERS, MAX_INFLIGHT)
+
+# جدول التوجيه قبل de_json — يجب أن يطابق الهاندلرز المسجّلة أعلاه:
+# الأوامر المتاحة لغير الأدمن؛ كل ما عداها من غير الأدمن لا يصل لأي هاندلر
+PUBLIC_COMMANDS = {"start", "help", "id"}
+
+def message_command(msg: dict) -> Optional[str]:
+    # نفس شرط CommandHandler: كيان bot_command في أول الرسالة
+    text = msg.get("text") or ""
+    entities = msg.get("entities") or ()
+    if not (entities and entities[0].get("type") == "bot_command" and entities[0].get("offset") == 0):
+        return None
+    return text[1:entities[0].get("length", 0)].split("@", 1)[0].lower()
+
+def route_update(data: dict) -> str:
+    """dispatch = مسار PTB الكامل، stopped = رد الإيقاف المباشر، ignore = لا هاندلر سيعالجه."""
+    msg = data.get("message")
+    if msg:
+        user_id = (msg.get("from") or {}).get("id")
+        if user_id is not None and is_admin(user_id):
+            return "dispatch"
+        return "dispatch" if message_command(msg) in PUBLIC_COMMANDS else "ignore"
+    cq = data.get("callback_query")
+    if cq:
+        user_id = (cq.get("from") or {}).get("id")
+        return "dispatch" if user_id is not None and is_admin(user_id) else "stopped"
+    return "ignore"
+
+async def answer_stopped_callback(cq: dict):
+    # ما يفعله admin_cb لغير الأدمن، مباشرة عبر Bot API بدون بناء كائنات PTB
+    status = "ok"
+    with metrics.timer("handler_seconds", handler="admin_cb", label="stopped"):
+        bot = application.bot
+        text, kb = stopped_message()
+        msg = cq.get("message")
+        try:
+            await bot.answer_callback_query(cq["id"])
+            try:
+                if msg:
+                    await bot.edit_message_text(text, chat_id=msg["chat"]["id"], message_id=msg["message_id"], reply_markup=kb)
+                elif cq.get("inline_message_id"):
+                    await bot.edit_message_text(text, inline_message_id=cq["inline_message_id"], reply_markup=kb)
+            except BadRequest:
+                pass  # الرسالة نفسها معروضة مسبقاً
+        except TelegramError as e:
+            # كما يفعل process_update في PTB: نسجّل الخطأ ولا نُفشل الويبهوك فيعيد تيليجرام الإرسال
+            status = "error"
+            log.warning("stopped callback failed: %s", e)
+    metrics.inc("handler_calls_total", handler="admin_cb", label="stopped", status=status)
+
+async def process_raw(data: dict):
+    update_id = data.get("update_id")
+    ok = False
+    try:
+        if update_id is not None and not await update_dedup.claim(update_id):
+            # عامل آخر يعالجه أو عالجه
+            metrics.inc("updates_duplicate_total")
+            ok = True
+            return
+        if route_update(data) == "stopped":
+            await answer_stopped_callback(data["callback_query"])
+        else:
+            update = Update.de_json(data, application.bot)
+            # ممر المعالجة — آمن مع PTB v21
+            await application.process_update(update)
+        ok = True
+    finally:
+        if update_id is not None:
+            await update_dedup.done(update_id, ok)
+
+class UpdateQueue:
+    """طابور تحديثات محدود مقسّم حسب المحادثة: كل محادثة تذهب دائماً لنفس العامل فيبقى ترتيبها محفوظاً."""
+
+    def __init__(self, workers: int, maxsize: int):
+        self.workers = max(1, workers)
+        self.shard_size = max(1, -(-maxsize // self.workers))
+        self._queues: List[asyncio.Queue] = []
+        self._tasks: List[asyncio.Task] = []
+        self.stats = {"enqueued": 0, "processed": 0, "rejected": 0, "errors": 0, "max_depth": 0}
+
+    def depth(self) -> int:
+        return sum(q.qsize() for q in self._queues)
+
+    def snapshot(self) -> Dict[str, int]:
+        return {**self.stats, "depth": self.depth(), "capacity": self.shard_size * self.workers,
+                "workers": self.workers}
+
+    def start(self):
+        if self._tasks:
+            return
+        self._queues = [asyncio.Queue(maxsize=self.shard_size) for _ in range(self.workers)]
+        self._tasks = [asyncio.create_task(self._worker(q)) for q in self._queues]
+
+    def put(self, data: dict) -> bool:
+        key = update_chat_id(data)
+        if key is None:
+            key = data.get("update_id", 0)
+        try:
+            self._queues[hash(key) % self.workers].put_nowait(data)
+        except asyncio.QueueFull:
+            self.stats["rejected"] += 1
+            return False
+        self.stats["enqueued"] += 1
+        self.stats["max_depth"] = max(self.stats["max_depth"], self.depth())
+        return True
+
+    async def _worker(self, q: asyncio.Queue):
+        while True:
+            data = await q.get()
+            try:
+                await process_raw(data)
+            except Exception:
+                self.stats["errors"] += 1
+                log.exception("update %s failed", data.get("update_id"))
+            finally:
+                self.stats["processed"] += 1
+                q.task_done()
+
+    async def stop(self):
+        # انتظر تفريغ ما في الطوابير ثم أوقف العمّال
+        for q in self._queues:
+            await q.join()
+        for task in self._tasks:
+            task.cancel()
+        await asyncio.gather(*self._tasks, return_exceptions=True)
+        self._tasks = []
+
+update_queue = UpdateQueue(UPDATE_WORKERS, UPDATE_QUEUE_SIZE)
+metrics.gauge("update_queue_depth", update_queue.depth, "Updates waiting in the ingestion queue")
+metrics.gauge("update_queue_rejected", lambda: update_queue.stats["rejected"], "Updates rejected because the queue was full")
+metrics.gauge("audit_log_pending", lambda: len(audit_log._pending), "Log rows waiting to be flushed")
+metrics.gauge("daily_activity_pending", lambda: len(daily_activity._pending), "Daily activity rows waiting to be flushed")
+metrics.gauge("user_upserts_pending", lambda: len(user_upserts._pending), "User upserts waiting to be flushed")
+metrics.gauge("broadcasts_running", lambda: len(broadcaster._tasks), "Broadcast jobs running in this worker")
+cache_refresher = PeriodicTask("cache_refresh", refresh_caches, interval=CACHE_REFRESH_SECONDS, delay=CACHE_REFRESH_SECONDS)
+broadcast_watchdog = PeriodicTask("broadcast_resume", broadcaster.resume, interval=60, delay=60)
+dedup_saver = PeriodicTask("dedup_persist", update_dedup.persist, interval=DEDUP_FLUSH_SECONDS, delay=DEDUP_FLUSH_SECONDS)
+metrics.gauge("updates_inflight", lambda: flood_guard.inflight, "Updates being processed inline right now")
+metrics.gauge("update_hwm", lambda: update_dedup.high, "Highest update_id processed by this worker")
+
 @app.on_event("startup")
 async def on_startup():
-    # ضبط الويبهوك بمفتاح سرّي
-    await application.bot.set_webhook(
-        url=f"{WEBHOOK_HOST}{WEBHOOK_PATH}",
-        secret_token=WEBHOOK_SECRET,
-        allowed_updates=["message", "callback_query"]
-    )
+    await prepare_db()
+    await db.open()
+    await application.initialize()
+    await warm_caches(force=True)
+    await warm_user_profiles()
+    await update_dedup.load()
+    dedup_saver.start()
+    user_upserts.start()
+    audit_log.start()
+    daily_activity.start()
+    if INGEST_MODE == "queue":
+        update_queue.start()
+    await broadcaster.resume()
+    broadcast_watchdog.start()
+    housekeeper.start()
+    cache_refresher.start()
+    # ضبط الويبهوك بمفتاح سرّي — عامل واحد يكفي عند التشغيل بعدة عمّال
+    if await acquire_lease("set_webhook", 60):
+        await application.bot.set_webhook(
+            url=f"{WEBHOOK_HOST}{WEBHOOK_PATH}",
+            secret_token=WEBHOOK_SECRET,
+            allowed_updates=["message", "callback_query"]
+        )
 
 @app.on_event("shutdown")
 async def on_shutdown():
-    await application.stop()
+    await update_queue.stop()
+    if application.running:
+        await application.stop()
+    await cache_refresher.stop()
+    await housekeeper.stop()
+    await broadcast_watchdog.stop()
+    await broadcaster.stop()
+    await application.shutdown()
+    await dedup_saver.stop()
+    await update_dedup.persist()
+    await user_upserts.stop()
+    await audit_log.stop()
+    await daily_activity.stop()
+    await db.close()
 
 @app.get("/")
 async def root():
-    return {"status": "ok", "bot": BOT_NAME, "webhook": WEBHOOK_PATH}
+    info = {"status": "ok", "bot": BOT_NAME, "webhook": WEBHOOK_PATH}
+    if INGEST_MODE == "queue":
+        info["queue"] = update_queue.snapshot()
+    return info
+
+@app.get("/metrics")
+async def metrics_endpoint(authorization: Optional[str] = Header(None)):
+    if METRICS_TOKEN and authorization != f"Bearer {METRICS_TOKEN}":
+        raise HTTPException(status_code=403, detail="Invalid token")
+    return PlainTextResponse(metrics.render(), media_type="text/plain; version=0.0.4")
+
+@app.get("/stats")
+async def stats_endpoint(days: int = 30, authorization: Optional[str] = Header(None)):
+    if not STATS_TOKEN:
+        raise HTTPException(status_code=404, detail="Not Found")
+    if authorization != f"Bearer {STATS_TOKEN}":
+        raise HTTPException(status_code=403, detail="Invalid token")
+    await flush_pending()
+    return JSONResponse(await stats_snapshot(min(max(days, 1), 366)))
 
 @app.post(WEBHOOK_PATH)
 async def telegram_webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str] = Header(None)):
+    t0 = time.perf_counter()
+    status = 200
+    try:
+        return await _handle_webhook(request, x_telegram_bot_api_secret_token)
+    except HTTPException as e:
+        status = e.status_code
+        raise
+    except Exception:
+        status = 500
+        raise
+    finally:
+        metrics.observe("webhook_seconds", time.perf_counter() - t0, mode=INGEST_MODE)
+        metrics.inc("webhook_requests_total", status=status)
+
+async def _handle_webhook(request: Request, x_telegram_bot_api_secret_token: Optional[str]):
     if x_telegram_bot_api_secret_token != WEBHOOK_SECRET:
         raise HTTPException(status_code=403, detail="Invalid secret")
-    data = await request.json()
-    update = Update.de_json(data, application.bot)
-    # ممر المعالجة — آمن مع PTB v21
-    await application.process_update(update)
+    body = await request.body()
+    # نقرأ update_id من النص الخام: التكرار يُرفض قبل تحليل JSON و de_json
+    m = UPDATE_ID_RE.search(body)
+    update_id = int(m.group(1)) if m else None
+    if update_id is not None and not update_dedup.begin(update_id):
+        metrics.inc("updates_duplicate_total")
+        return JSONResponse({"ok": True})
+    try:
+        data = json_loads(body)
+    except ValueError:
+        if update_id is not None:
+            await update_dedup.done(update_id, ok=False)
+        raise HTTPException(status_code=400, detail="Invalid JSON")
+    route = route_update(data)
+    metrics.inc("updates_routed_total", route=route)
+    if route == "ignore":
+        if update_id is not None:
+            await update_dedup.done(update_id)
+        return JSONResponse({"ok": True})
+    user_id = update_user_id(data)
+    if not flood_guard.allow(user_id):
+        # مستخدم يُغرق البوت: نتجاهل التحديث بصمت (200 كي لا يعيده تيليجرام)
+        metrics.inc("updates_shed_total", reason="flood")
+        if update_id is not None:
+            await update_dedup.done(update_id)
+        return JSONResponse({"ok": True})
+    if INGEST_MODE == "queue":
+        # ردّ فوري؛ عند امتلاء الطابور نرفض فيعيد تيليجرام الإرسال لاحقاً
+        if not update_queue.put(data):
+            if update_id is not None:
+                await update_dedup.done(update_id, ok=False)
+            metrics.inc("updates_shed_total", reason="queue_full")
+            raise HTTPException(status_code=503, detail="Update queue full")
+        return JSONResponse({"ok": True})
+    if not flood_guard.enter(user_id):
+        # ضغط عام: 503 فيعيد تيليجرام الإرسال لاحقاً بدل تكديس العمل على الكاتب
+        metrics.inc("updates_shed_total", reason="busy")
+        if update_id is not None:
+            await update_dedup.done(update_id, ok=False)
+        raise HTTPException(status_code=503, detail="Too many updates in flight")
+    try:
+        await process_raw(data)
+    finally:
+        flood_guard.leave()
     return JSONResponse({"ok": True})